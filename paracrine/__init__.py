@@ -12,10 +12,16 @@ Usage
 1. Setup Python. Tested against 3.13+
 2. `pip install paracrine`
 3. Write a main file describing what you want to setup. [integration_test/main.py](https://github.com/palfrey/paracrine/blob/main/integration_test/main.py) is a reasonable example. It must call the `run` function, which takes arguments for the inventory file, and list of modules to run.
-4. Write an inventory file for the machines this is managing. Current setup assumes they're all the same. [integration_test/docker/inventory.yaml](https://github.com/palfrey/paracrine/blob/main/integration_test/docker/inventory.yaml) is a reasonable example file, but I suggest generating it from whatever you're using to create the servers (e.g. Terraform).
+4. Write an inventory file for the machines this is managing. Current setup assumes they're all the same. Servers are connected to over SSH, but you can set `transport: local` to run directly on the machine running paracrine (e.g. for containers or CI), or `transport: sudo` for the same as root. [integration_test/docker/inventory.yaml](https://github.com/palfrey/paracrine/blob/main/integration_test/docker/inventory.yaml) is a reasonable example file, but I suggest generating it from whatever you're using to create the servers (e.g. Terraform).
 5. Write a <code>config.yaml</code>. This has a main top-level key of `environments` with keys below that for each inventory file you've got ([integration_test/config.yaml](https://github.com/palfrey/paracrine/blob/main/integration_test/config.yaml) just has one, but in most scenarios you'll have at least a dev and prod setup). What you do below that is up to you, but typically it'll be environment variables and secrets to feed into the main file.
 6. Run `python -m paracrine.commands.setup <inventory file>` - this will install the minimum python bits so that everything else works.
 7. Run the main file (e.g. `python main.py -i ./docker/inventory.yaml`)
+8. Optionally, for lots of repeated deploys, leave `python main.py -i ./docker/inventory.yaml --agent` running. Later runs of the same main file and inventory will attach to it and reuse its already open connections.
+9. For quick fixes, `--limit` picks which servers to run on (names, globs like `web-*`, or `role:<name>` for a role that has already been picked), and `--only`/`--skip` pick which modules to run. `--only` still runs the modules they depend on.
+10. To see where a run spends its time, add `--trace trace.json` and open the file in [Perfetto](https://ui.perfetto.dev). It has the connections, each module's `local`, `run` and `parse_return`, and every command run, per server.
+11. To see where the Python time in the servers' runs goes, add `--profile profiles/`. This writes a `.pstats` file and a `.folded` collapsed-stack file (for flame graphs, e.g. with [speedscope](https://www.speedscope.app)) per module, merged across all the servers.
+12. For large inventories, `--memory-report` shows the controller's peak memory and what it went on, and `--memory-budget <MB>` limits how many servers are sent calls at once to keep memory under that.
+13. Downloads (e.g. `download_executable` and `download_and_unpack`) are fetched once by the controller into `~/.cache/paracrine/artifacts` and sent to the servers over their connections, so servers don't need internet access for them. `--no-artifact-cache` has each server download them itself instead.
 
 Utilities
 ---
@@ -43,6 +49,12 @@ Writing a module file
 * `run` - Main function to run on the destination machine
 * `parse_return` - Function to run locally with an argument of the result of running `run`
 
+Modules without a `parse_return` are skipped on a server when nothing they use (their code and the code they import from paracrine or your project, the paracrine version, their options, the server's inventory entry, and the templates, configs and data files they read) has changed since they were last applied there. Pass `--force` to run them anyway, or set `skip_unchanged = False` in modules that check things outside of paracrine's control.
+
+Roles picked with `use_this_host` or `server_role_picker` are spread over servers with rendezvous hashing, so adding or removing a server only moves the roles it gains or held. Give a server a `selector_weight` in the inventory (default 1) to make it proportionally more or less likely to be picked.
+
+Modules can also set `cross_host_data = False` if their `run` doesn't need anything from the `parse_return` of other servers. Each server then starts them as soon as its own earlier modules are done, rather than waiting for every server.
+
 You can just use plain Python code, but `paracrine.helpers.fs/config/debian/network/python/systemd/users` have lots of useful functions you should preferably use instead.
 """
 
@@ -0,0 +1,151 @@
+"""Local agent for keeping connections warm between runs.
+
+Running a main file with `--agent` leaves a process holding the Mitogen router and the per-host
+connections open. Later runs of the same main file against the same inventory attach to it
+over a Unix socket, so they skip the SSH, sudo and bootstrap costs of a new connection.
+"""
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import socket
+import stat
+import sys
+import tempfile
+import threading
+import traceback
+from typing import Callable, List, TextIO, cast
+
+
+def _private_directory() -> str:
+    """Per-user directory for the sockets when there's no XDG_RUNTIME_DIR, as the temp directory
+    is shared and anyone could create a socket with the name we'd use there"""
+    path = os.path.join(tempfile.gettempdir(), f"paracrine-{os.getuid()}")
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(path)
+    if (
+        not stat.S_ISDIR(info.st_mode)
+        or info.st_uid != os.getuid()
+        or stat.S_IMODE(info.st_mode) != 0o700
+    ):
+        raise Exception(f"{path} isn't a directory only we can use, so not using it")
+    return path
+
+
+def socket_path(inventory_path: str) -> str:
+    key = "\0".join([os.path.abspath(inventory_path), os.path.abspath(sys.argv[0])])
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir is None:
+        runtime_dir = _private_directory()
+    return os.path.join(
+        runtime_dir,
+        "paracrine-agent-%s.sock"
+        % hashlib.sha256(key.encode("utf-8")).hexdigest()[:16],
+    )
+
+
+class _SocketWriter:
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.lock = threading.Lock()
+
+    def send(self, message: object) -> None:
+        with self.lock:
+            self.sock.sendall((json.dumps(message) + "\n").encode("utf-8"))
+
+    def write(self, output: str) -> int:
+        if output != "":
+            self.send({"output": output})
+        return len(output)
+
+    def flush(self) -> None:
+        pass
+
+
+def _handle(conn: socket.socket, handler: Callable[[List[str]], None]) -> None:
+    request = json.loads(conn.makefile("r").readline())
+    writer = _SocketWriter(conn)
+    log_handler = logging.StreamHandler(cast(TextIO, writer))
+    logging.root.addHandler(log_handler)
+    original_directory = os.getcwd()
+    try:
+        os.chdir(request["cwd"])
+        with contextlib.redirect_stdout(cast(TextIO, writer)):
+            handler(request["args"])
+        result: dict[str, object] = {"exit": 0}
+    except (Exception, SystemExit):
+        result = {"exit": 1, "error": traceback.format_exc()}
+    finally:
+        logging.root.removeHandler(log_handler)
+        os.chdir(original_directory)
+    writer.send(result)
+
+
+def serve(path: str, handler: Callable[[List[str]], None]) -> None:
+    """Runs `handler` with the arguments of each attached run, one at a time, until interrupted"""
+    if os.path.exists(path):
+        os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(old_umask)
+    server.listen()
+    print(f"Agent listening on {path}")
+    try:
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                try:
+                    _handle(conn, handler)
+                except OSError as e:
+                    print(f"Lost connection to attached run: {e}")
+    finally:
+        server.close()
+        os.remove(path)
+
+
+def attach(path: str, args: List[str]) -> bool:
+    """Runs with `args` in the agent listening on `path`, if there is one.
+
+    Returns False if there's no agent, and raises if the run in the agent fails"""
+    try:
+        info = os.lstat(path)
+    except FileNotFoundError:
+        return False
+    if (
+        not stat.S_ISSOCK(info.st_mode)
+        or info.st_uid != os.getuid()
+        or stat.S_IMODE(info.st_mode) & 0o077 != 0
+    ):
+        raise Exception(
+            f"{path} isn't a socket only we can use, so not attaching to it"
+        )
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        sock.close()
+        return False
+
+    with sock:
+        sock.sendall(
+            (json.dumps({"args": args, "cwd": os.getcwd()}) + "\n").encode("utf-8")
+        )
+        for line in sock.makefile("r"):
+            message = json.loads(line)
+            if "output" in message:
+                sys.stdout.write(message["output"])
+                sys.stdout.flush()
+            elif message["exit"] != 0:
+                raise Exception(f"Run in agent failed:\n{message['error']}")
+            else:
+                return True
+
+    raise Exception("Agent disconnected before the run finished")
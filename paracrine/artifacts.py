@@ -0,0 +1,144 @@
+"""Cache of downloaded artifacts on the controller.
+
+With the artifact cache on, `paracrine.helpers.fs.download` on a server asks the controller for
+the file rather than fetching it itself. The controller downloads each (url, sha) once into
+`ARTIFACTS_ROOT`, and streams it to the servers over their existing connections with Mitogen's
+FileService. The servers check the hash of what arrives, so they don't need internet access of
+their own, and N servers needing the same release only fetch it from the internet once.
+"""
+
+import hashlib
+import logging
+import os
+import re
+import threading
+from pathlib import Path
+from typing import Dict, Optional
+
+import mitogen.core
+import mitogen.service
+
+from paracrine import Pathy
+
+ARTIFACTS_ROOT = Path(
+    os.environ.get(
+        "PARACRINE_ARTIFACTS_ROOT",
+        os.path.expanduser("~/.cache/paracrine/artifacts"),
+    )
+)
+
+enabled = False
+_pool_router: Optional[mitogen.core.Router] = None
+
+# Set on the servers, to the controller context serving the cache
+_controller: Optional[mitogen.core.Context] = None
+
+
+def artifact_path(url: str, sha: str) -> Path:
+    """Where the artifact goes in the cache. Both parts come from the servers, so they're
+    checked to stop them being used to write elsewhere"""
+    if re.fullmatch("[0-9a-f]{64}", sha) is None:
+        raise Exception(f"{sha!r} isn't a sha256 hash")
+    name = url.split("/")[-1] or "artifact"
+    if "/" in name or ".." in name:
+        raise Exception(f"Can't cache {url} as {name!r}")
+    return ARTIFACTS_ROOT.joinpath(sha, name)
+
+
+class ArtifactService(mitogen.service.Service):
+    """Downloads artifacts for the servers, and makes them available through `file_service`"""
+
+    def __init__(
+        self, router: mitogen.core.Router, file_service: mitogen.service.FileService
+    ):
+        super().__init__(router)
+        self.file_service = file_service
+        self._lock = threading.Lock()
+        self._locks: Dict[str, threading.Lock] = {}
+
+    @mitogen.service.expose(policy=mitogen.service.AllowAny())
+    @mitogen.service.arg_spec({"url": str, "sha": str})
+    def fetch(self, url: str, sha: str) -> str:
+        path = artifact_path(url, sha)
+        with self._lock:
+            lock = self._locks.setdefault(str(path), threading.Lock())
+        # So several servers asking for the same artifact at once only download it once
+        with lock:
+            if not path.exists():
+                from .helpers.fs import fetch_url
+
+                logging.info("Downloading %s to the artifact cache" % url)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                fetch_url(url, path, sha)
+        self.file_service.register(str(path))
+        return str(path)
+
+
+def serve(router: mitogen.core.Router, new_enabled: bool) -> None:
+    """Turns the artifact cache on or off for runs using `router`"""
+    global enabled, _pool_router
+    enabled = new_enabled
+    if not enabled or _pool_router is router:
+        return
+    file_service = mitogen.service.FileService(router)
+    pool = mitogen.service.Pool(
+        router,
+        services=[file_service, ArtifactService(router, file_service)],
+        size=8,
+    )
+    mitogen.core.listen(router.broker, "shutdown", lambda: pool.stop(join=True))
+    _pool_router = router
+
+
+def controller(router: mitogen.core.Router) -> Optional[mitogen.core.Context]:
+    """The context for the servers to fetch artifacts from, if the cache is on"""
+    if not enabled or _pool_router is not router:
+        return None
+    return router.myself()
+
+
+def set_controller(context: Optional[mitogen.core.Context]) -> None:
+    global _controller
+    _controller = context
+
+
+class _HashingWriter:
+    def __init__(self, f: Pathy):
+        self.file = open(f, "wb")
+        self.hash = hashlib.sha256()
+
+    def write(self, data: bytes) -> None:
+        self.file.write(data)
+        self.hash.update(data)
+
+
+def fetch(url: str, sha: str, fname: Pathy) -> bool:
+    """Fetches `url` into `fname` from the controller's artifact cache.
+
+    Returns False if there's no cache to use, or the controller couldn't get the artifact, so
+    the caller can download it itself"""
+    context = _controller
+    if context is None:
+        return False
+    try:
+        path = context.call_service(ArtifactService.name(), "fetch", url=url, sha=sha)
+    except mitogen.core.CallError as e:
+        logging.warning("Unable to get %s from the artifact cache: %s" % (url, e))
+        return False
+
+    target = Path(os.path.realpath(fname))
+    temp_path = target.with_name(f".{target.name}.{os.urandom(4).hex()}.tmp")
+    try:
+        writer = _HashingWriter(temp_path)
+        with writer.file:
+            ok, _ = mitogen.service.FileService.get(context, path, writer)
+        if not ok:
+            raise Exception(f"Transfer of {url} from the artifact cache was cut short")
+        actual = writer.hash.hexdigest()
+        if actual != sha:
+            raise Exception(f"Expected {sha} for {url}, but got {actual}")
+        os.replace(temp_path, target)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+    return True
@@ -1,4 +1,5 @@
 import importlib
+import json
 from types import ModuleType
 from typing import (
     Any,
@@ -17,6 +18,7 @@ from typing import (
 from frozendict import deepfreeze, frozendict
 from mergedeep import merge
 
+from . import tracing
 from .helpers.config import clear_return_data, get_return_data, set_data
 
 ModuleConfig = Union[frozendict[str, object], Mapping[str, object]]
@@ -88,14 +90,17 @@ def runfunc(
             try:
                 if module.__name__ not in ret:
                     ret[module.__name__] = []
-                if module.__name__ in arguments:
-                    info = func(  # pyright: ignore[reportUnknownVariableType]
-                        arguments[module.__name__]  # pyright: ignore[reportCallIssue]
-                    )
-                else:
-                    # fmt: off
-                    info = func()  # pyright: ignore[reportCallIssue,reportUnknownVariableType]
-                    # fmt: on
+                with tracing.span(module.__name__, name):
+                    if module.__name__ in arguments:
+                        # fmt: off
+                        info = func(  # pyright: ignore[reportUnknownVariableType]
+                            arguments[module.__name__]  # pyright: ignore[reportCallIssue]
+                        )
+                        # fmt: on
+                    else:
+                        # fmt: off
+                        info = func()  # pyright: ignore[reportCallIssue,reportUnknownVariableType]
+                        # fmt: on
                 if isinstance(info, Dict):
                     info = merge({}, cast(Dict[str, object], info), get_return_data())
                 elif info is None:
@@ -122,6 +127,17 @@ def maketransmit_single(module: Module) -> TransmitModule:
         return (module[0].__name__, module[1])
 
 
+def _json_default(value: object) -> object:
+    if isinstance(value, Mapping):
+        return dict(cast(Mapping[str, object], value))
+    return str(value)
+
+
+def module_key(module: TransmitModule) -> str:
+    """Stable text form of a module and its options"""
+    return json.dumps(module, sort_keys=True, default=_json_default)
+
+
 def maketransmit(modules: Modules) -> TransmitModules:
     return [maketransmit_single(module) for module in modules]
 
@@ -0,0 +1,303 @@
+import ast
+import hashlib
+import importlib.metadata
+import importlib.util
+import json
+import logging
+import os
+import sys
+from pathlib import Path
+from types import ModuleType
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    TypedDict,
+    Union,
+)
+
+from .config import read_cached_bytes
+
+CACHE_ROOT = Path(os.environ.get("PARACRINE_CACHE_ROOT", "/var/cache/paracrine"))
+
+# Sections of the payload from `paracrine.helpers.config.create_data` that are sent as blobs
+TEXT_SECTIONS = ["templates", "configs"]
+BINARY_SECTIONS = ["data"]
+BLOBS_KEY = "blobs"
+
+_digests: Dict[Union[str, bytes], str] = {}
+_blobs: Dict[str, bytes] = {}
+
+
+def cache_path(*parts: str) -> Path:
+    return CACHE_ROOT.joinpath(*parts)
+
+
+def digest(content: Union[str, bytes]) -> str:
+    existing = _digests.get(content)
+    if existing is not None:
+        return existing
+    raw = content.encode("utf-8") if isinstance(content, str) else content
+    new_digest = hashlib.sha256(raw).hexdigest()
+    _digests[content] = new_digest
+    return new_digest
+
+
+def clear_digests() -> None:
+    _digests.clear()
+
+
+def blob_path(blob_digest: str) -> Path:
+    return cache_path("blobs", blob_digest[:2], blob_digest)
+
+
+def write_cache_file(path: Path, content: bytes) -> None:
+    # Avoids an import cycle, as fs uses the file hashes cache
+    from .fs import write_atomic
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Blobs can have secrets in
+    write_atomic(path, content, 0o600)
+
+
+def load_json_cache(name: str) -> Any:
+    try:
+        return json.loads(cache_path(name).read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def save_json_cache(name: str, value: object) -> None:
+    try:
+        write_cache_file(
+            cache_path(name), json.dumps(value, sort_keys=True).encode("utf-8")
+        )
+    except OSError as e:
+        logging.warning("Unable to save %s: %s" % (name, e))
+
+
+def store_blob(blob_digest: str, content: bytes) -> None:
+    _blobs[blob_digest] = content
+    try:
+        write_cache_file(blob_path(blob_digest), content)
+    except OSError as e:
+        logging.warning("Unable to cache blob %s: %s" % (blob_digest, e))
+
+
+def load_blob(blob_digest: str) -> bytes:
+    if blob_digest not in _blobs:
+        content = blob_path(blob_digest).read_bytes()
+        if hashlib.sha256(content).hexdigest() != blob_digest:
+            raise Exception(f"Corrupt blob in cache: {blob_path(blob_digest)}")
+        _blobs[blob_digest] = content
+    return _blobs[blob_digest]
+
+
+def missing_blobs(blob_digests: Iterable[str]) -> List[str]:
+    return [
+        blob_digest
+        for blob_digest in blob_digests
+        if blob_digest not in _blobs and not blob_path(blob_digest).exists()
+    ]
+
+
+def prune_blobs(keep: Iterable[str]) -> int:
+    """Removes all the blobs not in `keep`, so the contents of files that have since changed or
+    gone from the payload (e.g. old secrets) don't stay around. Returns how many were removed.
+    """
+    keep = set(keep)
+    for blob_digest in list(_blobs.keys()):
+        if blob_digest not in keep:
+            del _blobs[blob_digest]
+    clear_digests()
+    removed = 0
+    for path in cache_path("blobs").glob("*/*"):
+        if path.name in keep:
+            continue
+        try:
+            path.unlink()
+            removed += 1
+        except OSError as e:
+            logging.warning("Unable to remove blob %s: %s" % (path, e))
+    return removed
+
+
+def payload_digests(data: Mapping[str, Any]) -> Set[str]:
+    return set(
+        digest(content)
+        for section in TEXT_SECTIONS + BINARY_SECTIONS
+        for content in data[section].values()
+    )
+
+
+def hash_payload(data: Mapping[str, Any], known: Set[str]) -> Dict[str, Any]:
+    """Replaces the file contents in a payload with their digests, only including the contents
+    for the digests not in `known`. `resolve_payload` does the reverse on the other end.
+    """
+    ret = dict(data)
+    blobs: Dict[str, bytes] = {}
+    for section in TEXT_SECTIONS + BINARY_SECTIONS:
+        hashed: Dict[str, str] = {}
+        for name, content in data[section].items():
+            hashed[name] = digest(content)
+            if hashed[name] not in known:
+                blobs[hashed[name]] = (
+                    content.encode("utf-8") if isinstance(content, str) else content
+                )
+        ret[section] = hashed
+    ret[BLOBS_KEY] = blobs
+    return ret
+
+
+def resolve_payload(data: Mapping[str, Any]) -> Mapping[str, Any]:
+    if BLOBS_KEY not in data:
+        return data
+    for blob_digest, content in data[BLOBS_KEY].items():
+        store_blob(blob_digest, content)
+    ret = dict(data)
+    del ret[BLOBS_KEY]
+    for section in TEXT_SECTIONS:
+        ret[section] = dict(
+            (name, load_blob(blob_digest).decode("utf-8"))
+            for name, blob_digest in data[section].items()
+        )
+    for section in BINARY_SECTIONS:
+        ret[section] = dict(
+            (name, load_blob(blob_digest))
+            for name, blob_digest in data[section].items()
+        )
+    return ret
+
+
+FINGERPRINTS_FILENAME = "fingerprints.json"
+
+
+class Fingerprint(TypedDict):
+    fingerprint: str
+    # From `paracrine.helpers.config.recording_reads`
+    reads: List[List[str]]
+
+
+def input_fingerprint(
+    base: str, data: Mapping[str, Any], reads: Iterable[Sequence[str]]
+) -> str:
+    fingerprint = hashlib.sha256(base.encode("utf-8"))
+    rest = dict(
+        [
+            (key, value)
+            for key, value in data.items()
+            if key not in TEXT_SECTIONS + BINARY_SECTIONS
+        ]
+    )
+    fingerprint.update(json.dumps(rest, sort_keys=True, default=str).encode("utf-8"))
+    for section, name in sorted([(read[0], read[1]) for read in reads]):
+        names = sorted(data[section].keys()) if name == "*" else [name]
+        for read_name in names:
+            content = data[section].get(read_name)
+            content_digest = "missing" if content is None else digest(content)
+            fingerprint.update(
+                f"\0{section}\0{read_name}\0{content_digest}".encode("utf-8")
+            )
+    return fingerprint.hexdigest()
+
+
+def paracrine_version() -> str:
+    try:
+        return importlib.metadata.version("paracrine")
+    except importlib.metadata.PackageNotFoundError:
+        return "unknown"
+
+
+# Modules imported by each source file, along with the digest of the source they're from
+_source_imports: Dict[str, Tuple[str, List[str]]] = {}
+
+
+def _imported_names(module: ModuleType, source_path: str) -> List[str]:
+    source = read_cached_bytes(source_path)
+    source_digest = hashlib.sha256(source).hexdigest()
+    cached = _source_imports.get(source_path)
+    if cached is not None and cached[0] == source_digest:
+        return cached[1]
+    package = module.__package__ or ""
+    names: List[str] = []
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, ast.Import):
+            names.extend([alias.name for alias in node.names])
+        elif isinstance(node, ast.ImportFrom):
+            try:
+                base = importlib.util.resolve_name(
+                    "." * node.level + (node.module or ""), package
+                )
+            except (ImportError, ValueError):
+                continue
+            names.append(base)
+            # `from package import module`
+            names.extend([f"{base}.{alias.name}" for alias in node.names])
+    _source_imports[source_path] = (source_digest, names)
+    return names
+
+
+def _source_roots() -> List[str]:
+    import paracrine
+
+    return [os.path.dirname(os.path.abspath(paracrine.__file__)), os.getcwd()]
+
+
+def _is_local_source(source_path: str, roots: List[str]) -> bool:
+    path = os.path.abspath(source_path)
+    if path.startswith(roots[0] + os.sep):
+        return True
+    # The project, but not any virtualenv in it
+    return path.startswith(roots[1] + os.sep) and "site-packages" not in path
+
+
+def local_sources(module: ModuleType) -> Dict[str, str]:
+    roots = _source_roots()
+    sources: Dict[str, str] = {}
+    to_visit = [module]
+    while to_visit != []:
+        current = to_visit.pop()
+        source_path: Optional[str] = getattr(current, "__file__", None)
+        if (
+            current.__name__ in sources
+            or source_path is None
+            or not _is_local_source(source_path, roots)
+        ):
+            continue
+        sources[current.__name__] = source_path
+        for name in _imported_names(current, source_path):
+            parts = name.split(".")
+            for end in range(1, len(parts) + 1):
+                imported = sys.modules.get(".".join(parts[:end]))
+                if isinstance(imported, ModuleType):
+                    to_visit.append(imported)
+    return sources
+
+
+def code_fingerprint(base: str, module: ModuleType) -> str:
+    # Covers everything `module` imports (directly or not) from paracrine or the project
+    fingerprint = hashlib.sha256(base.encode("utf-8"))
+    for name, path in sorted(local_sources(module).items()):
+        fingerprint.update(f"\0{name}\0".encode("utf-8"))
+        fingerprint.update(read_cached_bytes(path))
+    return fingerprint.hexdigest()
+
+
+FILE_HASHES_FILENAME = "file-hashes.json"
+
+
+class FileHash(TypedDict):
+    stat: List[int]
+    """Inode, size, mtime_ns and ctime_ns of the file when it was hashed"""
+    sha256: str
+
+
+def stat_key(path: Union[str, Path]) -> List[int]:
+    st = os.stat(path)
+    return [st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns]
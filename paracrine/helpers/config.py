@@ -1,16 +1,22 @@
+import contextlib
 import json
 import os
 import pathlib
+import threading
 from typing import (
     Any,
     Callable,
     Dict,
     Iterator,
     List,
+    Literal,
     Mapping,
     NotRequired,
     Optional,
+    Set,
+    Tuple,
     TypedDict,
+    Union,
     cast,
 )
 
@@ -18,7 +24,7 @@ import jinja2
 import yaml
 from mergedeep import merge
 
-from paracrine import is_dry_run
+from paracrine import Pathy, is_dry_run
 
 
 class ServerDict(TypedDict):
@@ -29,6 +35,9 @@ class ServerDict(TypedDict):
     ssh_key: str
     ssh_user: str
     wireguard_ip: NotRequired[str]
+    selector_weight: NotRequired[float]
+    transport: NotRequired[Literal["ssh", "sudo", "local"]]
+    python_path: NotRequired[Union[str, List[str]]]
 
 
 class InventoryDict(TypedDict):
@@ -68,21 +77,56 @@ def config() -> InventoryDict:
     return data["config"]
 
 
+Read = Tuple[str, str]
+"""Section of the data payload and the name read from it, or "*" for all of that section"""
+
+# Per-thread, as modules can be run in parallel
+_reads = threading.local()
+
+
+def record_read(section: str, name: str) -> None:
+    reads: Optional[Set[Read]] = getattr(_reads, "value", None)
+    if reads is not None:
+        reads.add((section, name))
+
+
+@contextlib.contextmanager
+def recording_reads() -> Iterator[Set[Read]]:
+    """Collects what's read from the data payload (templates, configs and data files) in this
+    thread, so modules can be skipped when none of it has changed"""
+    previous: Optional[Set[Read]] = getattr(_reads, "value", None)
+    reads: Set[Read] = set()
+    _reads.value = reads
+    try:
+        yield reads
+    finally:
+        _reads.value = previous
+
+
 def data_files():
     assert data is not None
+    record_read("data", "*")
     return data["data"]
 
 
+def data_file(name: str) -> bytes:
+    assert data is not None
+    record_read("data", name)
+    return data["data"][name]
+
+
 def get_config_keys():
     assert data is not None
+    record_read("configs", "*")
     return data["configs"].keys()
 
 
 def get_config_file(fname: str) -> str:
-    if fname not in get_config_keys():
+    assert data is not None
+    record_read("configs", fname)
+    if fname not in data["configs"]:
         raise KeyError(f"Can't find {fname}. We have: {sorted(get_config_keys())}")
 
-    assert data is not None
     return data["configs"][fname]
 
 
@@ -91,7 +135,21 @@ def core_config():
 
 
 def set_data(new_data: Mapping[str, Any]) -> None:
-    loader = jinja2.DictLoader(new_data["templates"])
+    templates: Dict[str, str] = new_data["templates"]
+
+    def load_template(name: str) -> Optional[Tuple[str, str, Callable[[], bool]]]:
+        if name not in templates:
+            return None
+        record_read("templates", name)
+
+        def uptodate() -> bool:
+            # Called instead of loading again when the template is already compiled
+            record_read("templates", name)
+            return True
+
+        return (templates[name], name, uptodate)
+
+    loader = jinja2.FunctionLoader(load_template)
     global _jinja_env, data
     _jinja_env = jinja2.Environment(
         loader=loader, undefined=jinja2.StrictUndefined, keep_trailing_newline=True
@@ -99,20 +157,55 @@ def set_data(new_data: Mapping[str, Any]) -> None:
     data = new_data
 
 
-return_data: Dict[str, object] = {}
+# Per-thread, so that modules run in parallel don't see each other's return data
+_return_data = threading.local()
 
 
 def clear_return_data() -> None:
-    global return_data
-    return_data = {}
+    _return_data.value = {}
 
 
 def add_return_data(new_data: Dict[str, Any]) -> None:
-    merge(return_data, new_data)
+    merge(get_return_data(), new_data)
 
 
 def get_return_data() -> Dict[str, object]:
-    return return_data
+    if not hasattr(_return_data, "value"):
+        clear_return_data()
+    return _return_data.value
+
+
+# Cache of local file contents for a deploy (cleared at its start and end by
+# `paracrine.runner.deploy`), keyed on path and validated against (mtime, size) so that files
+# rewritten by e.g. parse_return get re-read, but nothing else does
+_file_cache: Dict[pathlib.Path, Tuple[int, int, Union[str, bytes]]] = {}
+
+
+def _read_cached(path: pathlib.Path, binary: bool) -> Union[str, bytes]:
+    st = path.stat()
+    cached = _file_cache.get(path)
+    if (
+        cached is not None
+        and cached[0] == st.st_mtime_ns
+        and cached[1] == st.st_size
+        and isinstance(cached[2], bytes) == binary
+    ):
+        return cached[2]
+    content = path.read_bytes() if binary else path.read_text()
+    _file_cache[path] = (st.st_mtime_ns, st.st_size, content)
+    return content
+
+
+def read_cached_text(path: Pathy) -> str:
+    return cast(str, _read_cached(pathlib.Path(path), False))
+
+
+def read_cached_bytes(path: Pathy) -> bytes:
+    return cast(bytes, _read_cached(pathlib.Path(path), True))
+
+
+def clear_file_cache() -> None:
+    _file_cache.clear()
 
 
 def add_folder_to_config(
@@ -141,7 +234,7 @@ def add_folder_to_config(
                     key = "/".join(parts[:-1]) + "/" + prefix + parts[-1]
                 else:
                     key = prefix + key
-            configs[key] = open(full).read()
+            configs[key] = read_cached_text(full)
         else:
             if prefix != "":
                 prefix += "/"
@@ -222,6 +315,19 @@ def walk(path: pathlib.Path) -> Iterator[pathlib.Path]:
         yield p.resolve()
 
 
+def create_configs() -> Dict[str, str]:
+    configs = {
+        CONFIG_NAME: read_cached_text(CONFIG_NAME),
+    }
+    add_folder_to_config(
+        configs,
+        config_path(),
+        shortname="configs",
+        filter=lambda f: not f.startswith("."),
+    )
+    return configs
+
+
 def create_data(server: Optional[ServerDict] = None):
     config = get_config()
     templates = {}
@@ -233,7 +339,7 @@ def create_data(server: Optional[ServerDict] = None):
         if not template_path.exists():
             continue
         for path in walk(template_path):
-            templates[path.name] = path.open("r").read()
+            templates[path.name] = read_cached_text(path)
 
     data = {}
     data_paths = [
@@ -250,23 +356,13 @@ def create_data(server: Optional[ServerDict] = None):
             except ValueError:
                 # Symlink outside of local folder
                 continue
-            data[local_path] = path.open("rb").read()
-
-    configs = {
-        CONFIG_NAME: open(CONFIG_NAME).read(),
-    }
-    add_folder_to_config(
-        configs,
-        config_path(),
-        shortname="configs",
-        filter=lambda f: not f.startswith("."),
-    )
+            data[local_path] = read_cached_bytes(path)
 
     return {
         "templates": templates,
         "host": server,
         "config": config,
-        "configs": configs,
+        "configs": create_configs(),
         "environment": environment(),
         "inventory": get_config(),
         "data": data,
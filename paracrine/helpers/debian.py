@@ -1,5 +1,6 @@
 import os
 import re
+import threading
 from glob import glob
 from pathlib import Path
 from typing import Dict, List, Optional, Union
@@ -19,17 +20,21 @@ from .fs import (
 
 host_arch: Optional[str] = None
 
+# dpkg only allows one user at a time, so modules running in parallel take turns
+_apt_lock = threading.RLock()
+
 _version_pattern = re.compile(r"Version: (\S+)")
 
 
 def apt_update():
-    return run_with_marker(
-        "/opt/apt-update",
-        "apt-get update --allow-releaseinfo-change",
-        deps=glob("/etc/apt/sources.list.d/*")
-        + glob("/etc/apt/trusted.gpg.d/*")
-        + ["/etc/apt/sources.list"],
-    )
+    with _apt_lock:
+        return run_with_marker(
+            "/opt/apt-update",
+            "apt-get update --allow-releaseinfo-change",
+            deps=glob("/etc/apt/sources.list.d/*")
+            + glob("/etc/apt/trusted.gpg.d/*")
+            + ["/etc/apt/sources.list"],
+        )
 
 
 def add_trusted_key(url: str, name: str, hash: str, armored: bool = True):
@@ -82,6 +87,15 @@ def apt_install(
     packages: Union[List[str], Dict[str, Optional[str]]],
     always_install: bool = False,
     target_release: Optional[str] = None,
+) -> bool:
+    with _apt_lock:
+        return _apt_install(packages, always_install, target_release)
+
+
+def _apt_install(
+    packages: Union[List[str], Dict[str, Optional[str]]],
+    always_install: bool,
+    target_release: Optional[str],
 ) -> bool:
     global host_arch
     dpkg_dev_req: Dict[str, Optional[str]] = {"dpkg-dev": "1.19"}
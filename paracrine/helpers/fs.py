@@ -1,21 +1,38 @@
 import contextlib
 import grp
 import hashlib
+import http.client
 import logging
 import os
 import pwd
 import re
 import select
+import shutil
 import stat
 import subprocess
+import tarfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from difflib import unified_diff
 from pathlib import Path
-from typing import List, Optional, Sequence, Tuple, TypedDict, Union, cast
+from typing import Dict, List, Optional, Sequence, Tuple, TypedDict, Union, cast
 
 from paracrine import Pathy, is_dry_run
 
-from .config import data_files, jinja_env
+from .. import artifacts, tracing
+from .cache import (
+    FILE_HASHES_FILENAME,
+    FileHash,
+    load_json_cache,
+    save_json_cache,
+    stat_key,
+)
+from .config import data_file, jinja_env
 
 
 def hash_data(data: bytes) -> str:
@@ -24,6 +41,53 @@ def hash_data(data: bytes) -> str:
     return m.hexdigest()
 
 
+# Beyond this (either side), the diff for a changed file isn't logged, as difflib is quadratic
+# in the worst case
+MAX_DIFF_BYTES = 256 * 1024
+
+
+def _describe_change(fname: Pathy, existing: bytes, contents: Union[str, bytes]) -> str:
+    if isinstance(contents, bytes):
+        return "File %s was different" % fname
+    if len(existing) > MAX_DIFF_BYTES or len(contents) > MAX_DIFF_BYTES:
+        return "File %s was different (too big to diff: %d bytes, was %d)" % (
+            fname,
+            len(contents.encode("utf-8")),
+            len(existing),
+        )
+    try:
+        data = existing.decode("utf-8").splitlines(True)
+    except UnicodeDecodeError:
+        return "File %s was different (was binary)" % fname
+    diff = "".join(unified_diff(data, contents.splitlines(True)))
+    return "File %s was different. Diff is: \n%s" % (fname, diff)
+
+
+# Nothing ever sees a partial file. Existing files keep their mode and owner
+def write_atomic(fname: Pathy, raw: bytes, mode: int = 0o666) -> None:
+    path = os.path.realpath(fname)
+    directory, name = os.path.split(path)
+    try:
+        existing: Optional[os.stat_result] = os.stat(path)
+    except FileNotFoundError:
+        existing = None
+    temp_path = os.path.join(directory, ".%s.%s.tmp" % (name, os.urandom(4).hex()))
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+    try:
+        with os.fdopen(fd, "wb") as temp_file:
+            temp_file.write(raw)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        if existing is not None:
+            os.chmod(temp_path, stat.S_IMODE(existing.st_mode))
+            if os.geteuid() == 0:
+                os.chown(temp_path, existing.st_uid, existing.st_gid)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
 def set_file_contents(
     fname: Pathy,
     contents: Union[str, bytes],
@@ -38,29 +102,26 @@ def set_file_contents(
             contents = contents.decode("utf-8")
         except UnicodeDecodeError:
             pass
+    raw = contents.encode("utf-8") if isinstance(contents, str) else contents
 
     if not os.path.exists(fname):
         needs_update = True
         logging.info("File %s was missing" % fname)
     elif not ignore_changes:
-        if isinstance(contents, str):
-            data = open(fname, "rb").read().decode("utf-8").splitlines(True)
-            diff = list(unified_diff(data, contents.splitlines(True)))
-            if len(diff) > 0:
-                diff = "".join(diff)
-                logging.info("File %s was different. Diff is: \n%s" % (fname, diff))
-                needs_update = True
+        # Sizes first, so most changes don't need the file read at all
+        existing: Optional[bytes] = None
+        if os.path.getsize(fname) != len(raw):
+            needs_update = True
         else:
-            data = open(fname, "rb").read()
-            if hash_data(data) != hash_data(contents):
-                logging.info("File %s was different" % fname)
-                needs_update = True
+            existing = Path(fname).read_bytes()
+            needs_update = existing != raw
+        if needs_update and logging.getLogger().isEnabledFor(logging.INFO):
+            if existing is None:
+                existing = Path(fname).read_bytes()
+            logging.info(_describe_change(fname, existing, contents))
 
     if needs_update and not is_dry_run():
-        if isinstance(contents, str):
-            open(fname, "w").write(contents)
-        else:
-            open(fname, "wb").write(contents)
+        write_atomic(fname, raw)
 
     needs_update = set_owner(fname, owner, group) or needs_update
 
@@ -82,7 +143,7 @@ def set_file_contents_from_template(
 
 
 def set_file_contents_from_data(fname: Pathy, data_path: str):
-    return set_file_contents(fname, data_files()[data_path])
+    return set_file_contents(fname, data_file(data_path))
 
 
 @contextlib.contextmanager
@@ -208,12 +269,27 @@ def insert_or_replace(
     return set_file_contents(fname, existing + "\n" + line)
 
 
-def sha_file(fname: Pathy) -> str:
-    from .debian import apt_install
+# For the read-modify-write of the file hashes cache, as `download_many` hashes files in threads
+_file_hashes_lock = threading.Lock()
 
-    apt_install(["coreutils"])
-    existing_sha = run_command("sha256sum %s" % fname, dry_run_safe=True).strip()
-    return existing_sha.split(" ")[0]
+
+def sha_file(fname: Pathy) -> str:
+    path = os.path.abspath(fname)
+    key = stat_key(path)
+    hashes: Dict[str, FileHash] = load_json_cache(FILE_HASHES_FILENAME)
+    existing = hashes.get(path)
+    if existing is not None and existing["stat"] == key:
+        return existing["sha256"]
+
+    with open(path, "rb") as f:
+        sha = hashlib.file_digest(f, "sha256").hexdigest()
+    # Only cache if nothing changed the file while it was being read
+    if stat_key(path) == key:
+        with _file_hashes_lock:
+            hashes = load_json_cache(FILE_HASHES_FILENAME)
+            hashes[path] = {"stat": key, "sha256": sha}
+            save_json_cache(FILE_HASHES_FILENAME, hashes)
+    return sha
 
 
 def has_sha(fname: Pathy, sha: str) -> bool:
@@ -225,18 +301,83 @@ def has_sha(fname: Pathy, sha: str) -> bool:
     return False
 
 
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_ATTEMPTS = 5
+# Seconds, multiplied by the attempt number
+DOWNLOAD_RETRY_DELAY = 1.0
+
+
+def _open_download(url: str, offset: int) -> http.client.HTTPResponse:
+    headers = {"Range": "bytes=%d-" % offset} if offset > 0 else {}
+    return urllib.request.urlopen(
+        urllib.request.Request(url, headers=headers), timeout=60
+    )
+
+
+def fetch_url(url: str, fname: Pathy, sha: str) -> None:
+    # Resumes from `<fname>.partial` with a Range request if that's already there
+    partial = Path("%s.partial" % fname)
+    hasher = hashlib.sha256()
+    for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+        hasher = hashlib.sha256()
+        offset = 0
+        if partial.exists():
+            with open(partial, "rb") as f:
+                hasher = hashlib.file_digest(f, "sha256")
+            offset = partial.stat().st_size
+        try:
+            with _open_download(url, offset) as response:
+                if offset > 0 and response.status != 206:
+                    # Server doesn't do ranges, so start again
+                    hasher = hashlib.sha256()
+                    offset = 0
+                with open(partial, "ab" if offset > 0 else "wb") as f:
+                    while chunk := response.read(DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                        hasher.update(chunk)
+                # read() just stops early if the connection drops
+                if response.length:
+                    raise http.client.IncompleteRead(b"", response.length)
+            break
+        except urllib.error.HTTPError as e:
+            # 416 is when there's nothing past what we've got, so either it's all there or it's
+            # not the same file and needs downloading again
+            if e.code == 416 and hasher.hexdigest() == sha:
+                break
+            if attempt == DOWNLOAD_ATTEMPTS or (e.code < 500 and e.code != 416):
+                raise
+            if e.code == 416:
+                partial.unlink()
+            logging.warning("Download of %s failed (%s), retrying" % (url, e))
+        except (OSError, http.client.HTTPException) as e:
+            if attempt == DOWNLOAD_ATTEMPTS:
+                raise
+            logging.warning("Download of %s failed (%s), resuming" % (url, e))
+        time.sleep(attempt * DOWNLOAD_RETRY_DELAY)
+
+    actual = hasher.hexdigest()
+    if actual != sha:
+        partial.unlink()
+        raise Exception(f"Expected {sha} for {url}, but got {actual}")
+    os.replace(partial, fname)
+
+
 def download(
     url: str, fname: Pathy, sha: str, mode: Union[int, str, None] = None
 ) -> bool:
     exists = has_sha(fname, sha)
     if not exists:
-        from .debian import apt_install
+        if is_dry_run():
+            logging.info("Would have downloaded %s to %s" % (url, fname))
+        elif not artifacts.fetch(url, sha, fname):
+            if url.startswith("https://"):
+                from .debian import apt_install
 
-        apt_install(["curl", "ca-certificates"])
-        run_command("curl -Lo %s %s" % (fname, url))
-        if not is_dry_run():
-            existing_sha = sha_file(fname)
-            assert existing_sha == sha, f"Expected {sha}, but got {existing_sha}"
+                # For verifying the certificate
+                apt_install(["ca-certificates"])
+            logging.info("Downloading %s to %s" % (url, fname))
+            with tracing.span(url, "download"):
+                fetch_url(url, fname, sha)
 
     if mode is not None:
         set_mode(fname, mode)
@@ -244,6 +385,19 @@ def download(
     return not exists
 
 
+def download_many(
+    downloads: Sequence[Tuple[str, Pathy, str]],
+    mode: Union[int, str, None] = None,
+    max_workers: int = 4,
+) -> List[bool]:
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(download, url, fname, sha, mode)
+            for url, fname, sha in downloads
+        ]
+        return [future.result() for future in futures]
+
+
 def link(target: Pathy, source: Pathy) -> bool:
     if os.path.lexists(target) and (
         not os.path.exists(target) or not os.path.samefile(source, target)
@@ -280,6 +434,64 @@ class Unpacked(TypedDict):
     dir_name: Pathy
 
 
+def _extract_zip(archive: str, directory: Path) -> None:
+    # zipfile leaves out the permissions, and writes symlinks as files with the target in
+    directory_modes: List[Tuple[str, int]] = []
+    with zipfile.ZipFile(archive) as z:
+        for info in z.infolist():
+            path = z.extract(info, directory)
+            mode = info.external_attr >> 16
+            if stat.S_ISLNK(mode):
+                target = Path(path).read_text()
+                resolved = os.path.realpath(os.path.join(os.path.dirname(path), target))
+                if not resolved.startswith("%s/" % os.path.realpath(directory)):
+                    raise Exception(f"{info.filename} in {archive} links outside it")
+                os.remove(path)
+                os.symlink(target, path)
+            elif info.is_dir():
+                directory_modes.append((path, mode))
+            elif stat.S_IMODE(mode) != 0:
+                os.chmod(path, stat.S_IMODE(mode))
+    # Directories last, in case they're not writable
+    for path, mode in reversed(directory_modes):
+        if stat.S_IMODE(mode) != 0:
+            os.chmod(path, stat.S_IMODE(mode))
+
+
+def _tar_filter(member: tarfile.TarInfo, path: str) -> tarfile.TarInfo:
+    # The "tar" filter's checks for paths outside the directory, but with all the mode bits kept
+    # as `tar -x` as root does
+    return tarfile.tar_filter(member, path).replace(mode=member.mode, deep=False)
+
+
+def _extract(archive: str, directory: Path) -> None:
+    if (
+        archive.endswith("tar.gz")
+        or archive.endswith(".tgz")
+        or archive.endswith("tar.xz")
+    ):
+        # Stream mode, as it's all read in order anyway
+        with tarfile.open(archive, "r|*") as tar:
+            tar.extractall(directory, filter=_tar_filter)
+    elif archive.endswith("zip"):
+        _extract_zip(archive, directory)
+    else:
+        raise Exception(archive)
+
+
+def _swap_directory(new: Path, target: Path) -> None:
+    old = target.with_name(target.name + ".old")
+    shutil.rmtree(old, ignore_errors=True)
+    if target.exists():
+        os.rename(target, old)
+    os.rename(new, target)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+# In directories unpacked by `download_and_unpack`, so it knows it can replace them
+UNPACKED_MARKER = ".paracrine-unpacked"
+
+
 def download_and_unpack(
     url: str,
     hash: str,
@@ -300,24 +512,31 @@ def download_and_unpack(
         hash,
     )
 
-    make_directory(dir_name)
     marker_name = Path(compressed_path + ".unpacked")
-    if not marker_name.exists():
-        from .debian import apt_install
-
-        if compressed_path.endswith("tar.gz") or compressed_path.endswith(".tgz"):
-            apt_install(["tar"])
-            run_command("tar --directory=%s -zxvf %s" % (dir_name, compressed_path))
-        elif compressed_path.endswith("tar.xz"):
-            apt_install(["tar", "xz-utils"])
-            run_command("tar --directory=%s -Jxvf %s" % (dir_name, compressed_path))
-        elif compressed_path.endswith("zip"):
-            apt_install(["unzip"])
-            run_command("unzip -q %s -d %s" % (compressed_path, dir_name))
+    if not marker_name.exists() or marker_name.read_text() != hash:
+        if is_dry_run():
+            logging.info("Would have unpacked %s to %s" % (compressed_path, dir_name))
         else:
-            raise Exception(compressed_path)
-
-        set_file_contents(marker_name, "")
+            logging.info("Unpacking %s to %s" % (compressed_path, dir_name))
+            target = Path(dir_name)
+            # Only directories this made get replaced, anything else is unpacked into
+            if target.exists() and not target.joinpath(UNPACKED_MARKER).exists():
+                with tracing.span(compressed_path, "unpack"):
+                    _extract(compressed_path, target)
+            else:
+                # Unpacked next to the target, so it can be swapped in with renames
+                staging = target.with_name(target.name + ".staging")
+                shutil.rmtree(staging, ignore_errors=True)
+                staging.mkdir(parents=True)
+                try:
+                    with tracing.span(compressed_path, "unpack"):
+                        _extract(compressed_path, staging)
+                    staging.joinpath(UNPACKED_MARKER).touch()
+                except BaseException:
+                    shutil.rmtree(staging, ignore_errors=True)
+                    raise
+                _swap_directory(staging, target)
+            set_file_contents(marker_name, hash)
 
         changed = True
 
@@ -483,15 +702,16 @@ def run_command_raw(
         if directory is not None:
             if run_for_real:
                 logging.info("Run in %s: %s" % (directory, display))
-                with cd(directory):
-                    process = subprocess.Popen(
-                        cmd,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        shell=True,
-                        stdin=subprocess.PIPE,
-                        env=local_env,
-                    )
+                # cwd rather than cd(), as changing directory affects every thread
+                process = subprocess.Popen(
+                    cmd,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    shell=True,
+                    stdin=subprocess.PIPE,
+                    env=local_env,
+                    cwd=directory,
+                )
             else:
                 logging.info("Would have run in %s: %s" % (directory, display))
         else:
@@ -509,48 +729,49 @@ def run_command_raw(
                 logging.info("Would have run: %s" % display)
 
         if run_for_real:
-            assert process is not None
-            assert process.stdout is not None
-            os.set_blocking(process.stdout.fileno(), False)
-            assert process.stderr is not None
-            os.set_blocking(process.stderr.fileno(), False)
-            stdout = b""
-            stderr = b""
-            DUMP_COMMAND = os.environ.get("DUMP_COMMAND", "false").lower() == "true"
-            assert process.stdin is not None
-            if input is not None:
-                process.stdin.write(input)
-            process.stdin.close()
-            while True:
-
-                def get_output() -> bool:
-                    nonlocal stdout, stderr
-                    new_stdout, new_stderr = non_breaking_communicate(process)
-                    stdout += new_stdout
-                    if DUMP_COMMAND and new_stdout != b"":
-                        print(new_stdout.decode("utf-8"), end=None)
-                    stderr += new_stderr
-                    if DUMP_COMMAND and new_stderr != b"":
-                        print(new_stderr.decode("utf-8"), end=None)
-                    return new_stdout != b"" or new_stderr != b""
-
-                get_output()
-                maybe_returncode = process.poll()
-                if maybe_returncode is None:
-                    continue
-                while get_output():
-                    pass
-                if maybe_returncode not in allowed_exit_codes:
-                    if b": not found" in stderr or process.returncode == 127:
-                        # missing command
-                        print(stderr)
-                        raise MissingCommandException
-                    if process.returncode not in allowed_exit_codes:
-                        raise subprocess.CalledProcessError(
-                            process.returncode, cmd, stdout, stderr
-                        )
-                break
-            return stdout
+            with tracing.span(display, "subprocess"):
+                assert process is not None
+                assert process.stdout is not None
+                os.set_blocking(process.stdout.fileno(), False)
+                assert process.stderr is not None
+                os.set_blocking(process.stderr.fileno(), False)
+                stdout = b""
+                stderr = b""
+                DUMP_COMMAND = os.environ.get("DUMP_COMMAND", "false").lower() == "true"
+                assert process.stdin is not None
+                if input is not None:
+                    process.stdin.write(input)
+                process.stdin.close()
+                while True:
+
+                    def get_output() -> bool:
+                        nonlocal stdout, stderr
+                        new_stdout, new_stderr = non_breaking_communicate(process)
+                        stdout += new_stdout
+                        if DUMP_COMMAND and new_stdout != b"":
+                            print(new_stdout.decode("utf-8"), end=None)
+                        stderr += new_stderr
+                        if DUMP_COMMAND and new_stderr != b"":
+                            print(new_stderr.decode("utf-8"), end=None)
+                        return new_stdout != b"" or new_stderr != b""
+
+                    get_output()
+                    maybe_returncode = process.poll()
+                    if maybe_returncode is None:
+                        continue
+                    while get_output():
+                        pass
+                    if maybe_returncode not in allowed_exit_codes:
+                        if b": not found" in stderr or process.returncode == 127:
+                            # missing command
+                            print(stderr)
+                            raise MissingCommandException
+                        if process.returncode not in allowed_exit_codes:
+                            raise subprocess.CalledProcessError(
+                                process.returncode, cmd, stdout, stderr
+                            )
+                    break
+                return stdout
         else:
             return b""
     except subprocess.CalledProcessError as e:
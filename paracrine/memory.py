@@ -0,0 +1,86 @@
+"""Accounting of the controller's memory use.
+
+With the memory report on, tracemalloc traces the controller's allocations, and each phase of
+talking to the servers (building payloads, pickling them, unpickling results and running
+`parse_return`) records how far it pushed memory use up, and how much of that it kept.
+"""
+
+import contextlib
+import threading
+import tracemalloc
+from typing import Dict, Iterator, List, TypedDict
+
+
+class PhaseStats(TypedDict):
+    calls: int
+    peak: int
+    """Largest growth over the memory in use at the start of any one call"""
+    retained: int
+    """Total memory still in use at the end of the calls, that wasn't at the start"""
+
+
+enabled = False
+_lock = threading.Lock()
+_phases: Dict[str, PhaseStats] = {}
+_peak = 0
+
+
+def set_memory_report(new_enabled: bool) -> None:
+    """Turns memory accounting on or off, dropping any stats so far"""
+    global enabled, _peak
+    if new_enabled and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    elif not new_enabled and enabled:
+        tracemalloc.stop()
+    enabled = new_enabled
+    with _lock:
+        _phases.clear()
+        _peak = 0
+
+
+def _note_peak(peak: int) -> None:
+    global _peak
+    _peak = max(_peak, peak)
+
+
+@contextlib.contextmanager
+def phase(name: str) -> Iterator[None]:
+    if not enabled:
+        yield
+        return
+    with _lock:
+        start, peak = tracemalloc.get_traced_memory()
+        _note_peak(peak)
+        tracemalloc.reset_peak()
+    try:
+        yield
+    finally:
+        with _lock:
+            current, peak = tracemalloc.get_traced_memory()
+            _note_peak(peak)
+            stats = _phases.setdefault(name, {"calls": 0, "peak": 0, "retained": 0})
+            stats["calls"] += 1
+            stats["peak"] = max(stats["peak"], peak - start)
+            stats["retained"] += current - start
+
+
+def phases() -> Dict[str, PhaseStats]:
+    with _lock:
+        return dict(_phases)
+
+
+def _mib(size: int) -> str:
+    return "%.1f MiB" % (size / 1024 / 1024)
+
+
+def report() -> List[str]:
+    with _lock:
+        _note_peak(tracemalloc.get_traced_memory()[1])
+        lines = [f"Peak controller memory: {_mib(_peak)}"]
+        for name, stats in sorted(
+            _phases.items(), key=lambda item: item[1]["peak"], reverse=True
+        ):
+            lines.append(
+                f"* {name}: {_mib(stats['peak'])} peak, {_mib(stats['retained'])} retained over {stats['calls']} calls"
+            )
+    return lines
@@ -0,0 +1,149 @@
+"""Profiling of remote runs.
+
+With profiling on, each module run on a server is run under cProfile, and the stats are sent back
+with the results. `write_profiles` merges them per module across all the servers, and writes a
+pstats file (for `python -m pstats` or snakeviz) and a collapsed-stack file (for flamegraph.pl
+or speedscope) for each module. Modules run at the same time with `--parallel` are profiled
+together (as only one profiler can run at once), so they get one set of files for all of them.
+"""
+
+import contextlib
+import cProfile
+import marshal
+import os
+import pstats
+import threading
+from typing import Any, Dict, Iterator, List, Tuple, cast
+
+# Key used to send the stats from a remote call back with its results
+PROFILE_KEY = "__paracrine_profile__"
+
+FunctionKey = Tuple[str, int, str]
+RawStats = Dict[FunctionKey, Tuple[int, int, float, float, Dict[FunctionKey, Any]]]
+"""The `stats` attribute of `pstats.Stats`"""
+
+enabled = False
+_lock = threading.Lock()
+_remote_stats: Dict[str, List[bytes]] = {}
+_merged: Dict[str, pstats.Stats] = {}
+
+
+def set_profiling(new_enabled: bool) -> None:
+    """Turns profiling on or off, dropping any stats so far"""
+    global enabled
+    enabled = new_enabled
+    with _lock:
+        _remote_stats.clear()
+        _merged.clear()
+
+
+@contextlib.contextmanager
+def profiled(name: str) -> Iterator[None]:
+    """Profiles the code run in this block (and only in this thread) as part of module `name`"""
+    if not enabled:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.create_stats()
+        stats = marshal.dumps(getattr(profiler, "stats"))
+        with _lock:
+            _remote_stats.setdefault(name, []).append(stats)
+
+
+def take_stats() -> Dict[str, List[bytes]]:
+    with _lock:
+        stats = dict(_remote_stats)
+        _remote_stats.clear()
+    return stats
+
+
+class _LoadedStats:
+    # What `pstats.Stats` needs to load stats that aren't in a file
+    def __init__(self, stats: RawStats):
+        self.stats = stats
+
+    def create_stats(self) -> None:
+        pass
+
+
+def add_remote_stats(stats: Dict[str, List[bytes]]) -> None:
+    with _lock:
+        for name, all_raw in stats.items():
+            for raw in all_raw:
+                loaded = cast(cProfile.Profile, _LoadedStats(marshal.loads(raw)))
+                if name in _merged:
+                    _merged[name].add(loaded)
+                else:
+                    _merged[name] = pstats.Stats(loaded)
+
+
+def _function_name(function: FunctionKey) -> str:
+    filename, line, name = function
+    if filename == "~":
+        # Built-in functions
+        return name
+    return f"{name} ({os.path.basename(filename)}:{line})"
+
+
+def collapsed_stacks(stats: RawStats, max_depth: int = 100) -> List[str]:
+    """Approximate stacks, in the collapsed format of flamegraph.pl.
+
+    cProfile only records callers, not whole stacks, so the time of a function called from
+    several places is shared out to each of those stacks by how much time each caller spent in
+    it"""
+    callees: Dict[FunctionKey, List[Tuple[FunctionKey, float]]] = {}
+    roots: List[FunctionKey] = []
+    for function, (_, _, _, _, callers) in stats.items():
+        if callers == {}:
+            roots.append(function)
+        for caller, caller_stats in callers.items():
+            callees.setdefault(caller, []).append((function, caller_stats[3]))
+
+    lines: Dict[str, float] = {}
+
+    def walk(function: FunctionKey, stack: List[FunctionKey], share: float) -> None:
+        stack = stack + [function]
+        _, _, own_time, total_time, _ = stats[function]
+        key = ";".join([_function_name(frame) for frame in stack])
+        lines[key] = lines.get(key, 0.0) + own_time * share
+        if len(stack) >= max_depth or total_time == 0:
+            return
+        for callee, callee_time in callees.get(function, []):
+            if callee in stack or callee not in stats:
+                continue
+            callee_total = stats[callee][3]
+            if callee_total == 0:
+                continue
+            walk(callee, stack, share * callee_time / callee_total)
+
+    for root in roots:
+        walk(root, [], 1.0)
+
+    # Microseconds, as flamegraph.pl wants whole numbers
+    return [
+        f"{key} {round(value * 1_000_000)}"
+        for key, value in sorted(lines.items())
+        if round(value * 1_000_000) > 0
+    ]
+
+
+def write_profiles(directory: str) -> List[str]:
+    """Writes a .pstats and .folded file for each profiled module, returning the paths"""
+    os.makedirs(directory, exist_ok=True)
+    paths: List[str] = []
+    with _lock:
+        merged = dict(_merged)
+    for name, stats in sorted(merged.items()):
+        pstats_path = os.path.join(directory, f"{name}.pstats")
+        stats.dump_stats(pstats_path)
+        folded_path = os.path.join(directory, f"{name}.folded")
+        with open(folded_path, "w") as f:
+            for line in collapsed_stacks(getattr(stats, "stats")):
+                f.write(line + "\n")
+        paths.extend([pstats_path, folded_path])
+    return paths
@@ -1,18 +1,39 @@
 import argparse
+import contextlib
+import fnmatch
 import json
 import logging
+import math
 import os
-from typing import Any, Callable, Dict, List, Mapping, TypedDict, Union, cast
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from types import ModuleType
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Set,
+    Tuple,
+    TypedDict,
+    Union,
+    cast,
+)
 
-from mergedeep import merge
-from mitogen.core import Error, Receiver, StreamError
+from mitogen.core import Error, Receiver, StreamError, listen
 from mitogen.parent import Context, EofError, Router
+from mitogen.select import Select
 from mitogen.ssh import HostKeyError
 from mitogen.utils import run_with_router
 from retry.api import retry_call
 
 from paracrine import DRY_RUN_ENV
 
+from . import agent, artifacts, memory, profiling, tracing
 from .deps import (
     Module,
     Modules,
@@ -22,19 +43,41 @@ from .deps import (
     makereal,
     maketransmit,
     maketransmit_single,
+    module_key,
     runfunc,
     unfreeze_module,
 )
+from .helpers.cache import (
+    BINARY_SECTIONS,
+    FINGERPRINTS_FILENAME,
+    TEXT_SECTIONS,
+    Fingerprint,
+    clear_digests,
+    code_fingerprint,
+    digest,
+    hash_payload,
+    input_fingerprint,
+    load_json_cache,
+    missing_blobs,
+    paracrine_version,
+    payload_digests,
+    prune_blobs,
+    resolve_payload,
+    save_json_cache,
+)
 from .helpers.config import (
+    CONFIG_NAME,
     ServerDict,
+    clear_file_cache,
+    create_configs,
     create_data,
     get_config,
-    other_config_file,
     path_to_config_file,
+    read_cached_text,
+    recording_reads,
     set_config,
     set_data,
 )
-from .helpers.fs import set_file_contents
 from .runners import core
 
 
@@ -48,16 +91,213 @@ def decode(info: Dict[Union[bytes, str], Union[bytes, str]]):
 
 
 ssh_cache: Dict[str, Context] = {}
+# Digests of the blobs we know each of the `ssh_cache` contexts already has
+known_blobs: Dict[str, Set[str]] = {}
+# Server name and digests of the blobs sent to each of the `ssh_cache` contexts this run
+used_blobs: Dict[str, Tuple[str, Set[str]]] = {}
 
 
 def clear_ssh_cache():
-    global ssh_cache
+    global ssh_cache, known_blobs, used_blobs
     ssh_cache = {}
+    known_blobs = {}
+    used_blobs = {}
+
+
+def forget_connection(cache_key: str) -> None:
+    ssh_cache.pop(cache_key, None)
+    known_blobs.pop(cache_key, None)
+    used_blobs.pop(cache_key, None)
+
+
+MAX_CONCURRENT_CONNECTIONS = 20
+
+
+def connection_address(server: ServerDict, wg: bool) -> Tuple[str, int]:
+    hostname = (
+        server["wireguard_ip"]
+        if wg and "wireguard_ip" in server
+        else server["ssh_hostname"]
+    )
+    port = 22 if wg else server.get("ssh_port", 22)
+    return (hostname, port)
+
+
+def connection_key(server: ServerDict, wg: bool) -> str:
+    transport = server.get("transport", "ssh")
+    if transport != "ssh":
+        return f"{transport}-{server['name']}"
+    hostname, port = connection_address(server, wg)
+    return f"{hostname}-{port}"
+
+
+def connect(router: Router, server: ServerDict, wg: bool) -> Context:
+    transport = server.get("transport", "ssh")
+    if transport == "local":
+        return router.local(python_path=server.get("python_path", sys.executable))
+    elif transport == "sudo":
+        return router.sudo(
+            python_path=server.get("python_path", "python3"), preserve_env=True
+        )
+    elif transport != "ssh":
+        raise Exception(
+            f"Unknown transport '{transport}' for {server['name']}, must be one of ssh, sudo or local"
+        )
+
+    hostname, port = connection_address(server, wg)
+    key_path = path_to_config_file(server["ssh_key"]).resolve()
+    if not os.path.exists(key_path):
+        raise Exception(f"Can't find ssh key {key_path}")
+    username = server["ssh_user"]
+
+    try:
+        connect = retry_call(
+            router.ssh,
+            exceptions=EofError,
+            tries=3,
+            fkwargs={
+                "hostname": hostname,
+                "port": port,
+                "username": username,
+                "identity_file": key_path.as_posix(),
+                "check_host_keys": "accept",
+                "python_path": server.get("python_path", "python3"),
+                "ssh_args": ["-o", "SendEnv DUMP_COMMAND"],
+            },
+        )
+    except HostKeyError:
+        print(
+            f"HostKeyError while trying to login to to {username}@{hostname}:{port}. Try running the following manually: ssh {username}@{hostname} -p {port} -i {key_path}"
+        )
+        raise
+    except StreamError:
+        print(f"Exception while trying to login to {username}@{hostname}:{port}")
+        raise
+
+    if username != "root":
+        return router.sudo(
+            via=connect,
+            python_path=server.get("python_path", "python3"),
+            preserve_env=True,
+        )
+    else:
+        return connect
+
+
+def traced_connect(router: Router, server: ServerDict, wg: bool) -> Context:
+    with tracing.track(server["name"]), tracing.span("connect", "connect"):
+        return connect(router, server, wg)
+
+
+def connect_all(
+    router: Router,
+    targets: List[Tuple[str, ServerDict]],
+    wg: bool,
+    tolerate_failures: bool = False,
+) -> Dict[str, Exception]:
+    to_connect = dict(
+        [
+            (cache_key, server)
+            for cache_key, server in targets
+            if cache_key not in ssh_cache
+        ]
+    )
+    if to_connect == {}:
+        return {}
+
+    errors: Dict[str, Exception] = {}
+    with ThreadPoolExecutor(
+        max_workers=min(MAX_CONCURRENT_CONNECTIONS, len(to_connect))
+    ) as executor:
+        futures = dict(
+            [
+                (cache_key, executor.submit(traced_connect, router, server, wg))
+                for cache_key, server in to_connect.items()
+            ]
+        )
+        for cache_key, future in futures.items():
+            try:
+                ssh_cache[cache_key] = future.result()
+            except Exception as e:
+                errors[cache_key] = e
+                continue
+            # Long-lived runs (e.g. the agent) shouldn't keep using dead connections
+            listen(
+                ssh_cache[cache_key],
+                "disconnect",
+                partial(forget_connection, cache_key),
+            )
+
+    if tolerate_failures or len(errors) == 0:
+        return errors
+    elif len(errors) == 1:
+        raise list(errors.values())[0]
+    else:
+        raise Exception(list(errors.values()))
+
+
+# Gets the servers that succeeded in each rolling batch, and returns False to stop the run
+HealthCheck = Callable[[List[str]], bool]
+
+
+class RollingOptions(TypedDict):
+    batch_size: str
+    max_failures: int
+    health_check: Optional[HealthCheck]
+
+
+# When set, the deploy is done to batches of servers in turn rather than all at once
+rolling: Optional[RollingOptions] = None
+# Servers that have failed in this rolling deploy, which get no further calls
+failed_servers: Dict[str, Exception] = {}
+
+
+def set_rolling(new_rolling: Optional[RollingOptions]) -> None:
+    global rolling
+    rolling = new_rolling
+    failed_servers.clear()
+
+
+def record_failure(server_name: str, error: Exception) -> None:
+    assert rolling is not None
+    failed_servers[server_name] = error
+    if len(failed_servers) > rolling["max_failures"]:
+        print(
+            f"Stopping rolling run as {len(failed_servers)} failures is more than the maximum of {rolling['max_failures']}"
+        )
+        raise Exception(list(failed_servers.values()))
+
+
+# Raise on the first failed server, rather than waiting for the rest
+fail_fast = False
+
+
+def set_fail_fast(new_fail_fast: bool) -> None:
+    global fail_fast
+    fail_fast = new_fail_fast
+
+
+def batch_count(batch_size: str, total: int) -> int:
+    # Either a count (e.g. "5") or a percentage (e.g. "25%")
+    if batch_size.endswith("%"):
+        count = math.ceil(total * float(batch_size[:-1]) / 100)
+    else:
+        count = int(batch_size)
+    return max(1, count)
 
 
 class MainReturn(TypedDict):
     infos: List[Any]
     data: Mapping[str, object]
+    servers: List[str]
+    """Names of the servers each of `infos` is from"""
+
+
+# Function to call on a server, with the arguments to pass after the data payload
+RemoteCall = Tuple[Callable[..., Any], Tuple[Any, ...], Dict[str, Any]]
+
+# Gets each server's result as it arrives, and returns the next call for it (or None)
+OnResult = Callable[[ServerDict, Any, Mapping[str, object]], Optional[RemoteCall]]
 
 
 def main(
@@ -66,89 +306,522 @@ def main(
     func: Callable[..., Any],
     *args: Any,
     **kwargs: Any,
+) -> MainReturn:
+    return run_on_servers(router, servers, (func, args, kwargs))
+
+
+# Rough limit in bytes on the controller memory for calls in flight, or None for no limit
+memory_budget: Optional[int] = None
+
+
+def set_memory_budget(new_memory_budget: Optional[int]) -> None:
+    global memory_budget
+    memory_budget = new_memory_budget
+
+
+# Allowance for everything in a call other than the file contents
+CALL_OVERHEAD = 64 * 1024
+
+
+def payload_sizes(data: Mapping[str, Any]) -> Dict[str, int]:
+    return dict(
+        [
+            (digest(content), len(content))
+            for section in TEXT_SECTIONS + BINARY_SECTIONS
+            for content in data[section].values()
+        ]
+    )
+
+
+def call_memory(blob_sizes: Dict[str, int], known: Set[str]) -> int:
+    # Contents the server doesn't have are held both in the payload and the pickled message
+    return CALL_OVERHEAD + 2 * sum(
+        [size for blob_digest, size in blob_sizes.items() if blob_digest not in known]
+    )
+
+
+def run_on_servers(
+    router: Router,
+    servers: Union[list[str], None],
+    first_call: RemoteCall,
+    on_result: Optional[OnResult] = None,
 ) -> MainReturn:
     config = get_config()
-    calls: List[Receiver] = []
     wg = core.is_wireguard()
-    data = {}
-    for server in config["servers"]:
-        if servers is not None and server["name"] not in servers:
+    data: Dict[str, Any] = {}
+    targets: List[Tuple[str, ServerDict]] = [
+        (connection_key(server, wg), server)
+        for server in config["servers"]
+        if (servers is None or server["name"] in servers)
+        and server["name"] not in failed_servers
+    ]
+    results: Dict[str, Any] = {}
+    errors: List[Exception] = []
+
+    def server_failed(server: ServerDict, error: Exception) -> None:
+        errors.append(error)
+        if rolling is not None:
+            record_failure(server["name"], error)
+
+    connect_errors = connect_all(
+        router, targets, wg, tolerate_failures=rolling is not None
+    )
+    for cache_key, server in targets:
+        if cache_key in connect_errors:
+            print(f"Unable to connect to {server['name']}", connect_errors[cache_key])
+            server_failed(server, connect_errors[cache_key])
+    targets = [target for target in targets if target[0] not in connect_errors]
+
+    if targets == []:
+        return {"infos": [], "data": data, "servers": []}
+
+    # Templates, data and configs are the same for every server, so only build them once
+    with memory.phase("payload"):
+        shared_data = create_data()
+        digests = payload_digests(shared_data)
+    blob_sizes = payload_sizes(shared_data)
+    checks = dict(
+        [
+            (cache_key, ssh_cache[cache_key].call_async(missing_blobs, sorted(digests)))
+            for cache_key, _ in targets
+            if cache_key not in known_blobs
+        ]
+    )
+    for cache_key, server in targets:
+        if cache_key not in checks:
             continue
-        hostname = (
-            server["wireguard_ip"]
-            if wg and "wireguard_ip" in server
-            else server["ssh_hostname"]
+        try:
+            known_blobs[cache_key] = digests.difference(
+                checks[cache_key].get().unpickle()
+            )
+        except Error as e:
+            print(f"Got error from {server['name']}", e)
+            server_failed(server, e)
+    if rolling is None and len(errors) > 0:
+        raise Exception(errors)
+    targets = [
+        (cache_key, server)
+        for cache_key, server in targets
+        if server["name"] not in failed_servers
+    ]
+
+    pending: Dict[
+        Receiver,
+        Tuple[str, ServerDict, Dict[str, Any], float, RemoteCall, float, int],
+    ] = {}
+    select = Select()
+    # Calls waiting for memory to start, and the estimated memory of those in flight
+    waiting: List[Tuple[str, ServerDict, RemoteCall]] = []
+    in_flight = 0
+
+    def known(cache_key: str, remote_call: RemoteCall) -> Set[str]:
+        # Only `do` resolves blobs, so everything else gets the full contents
+        return known_blobs[cache_key] if remote_call[0] is do else set()
+
+    def start_call(cache_key: str, server: ServerDict, remote_call: RemoteCall) -> None:
+        nonlocal shared_data, digests, data, blob_sizes, in_flight
+        if remote_call is not first_call:
+            # Earlier results may have changed the configs, but only parse_return writes files,
+            # and only into the configs, so the templates and data are kept from the first call
+            with memory.phase("payload"):
+                shared_data = {**shared_data, "configs": create_configs()}
+                digests = payload_digests(shared_data)
+            blob_sizes = payload_sizes(shared_data)
+        func, args, kwargs = remote_call
+        cost = call_memory(blob_sizes, known(cache_key, remote_call))
+        with memory.phase("payload"):
+            data = {**shared_data, "host": server}
+            payload = hash_payload(data, known_blobs[cache_key]) if func is do else data
+        with memory.phase("pickle"):
+            call = ssh_cache[cache_key].call_async(func, payload, *args, **kwargs)
+        if func is do:
+            known_blobs[cache_key].update(digests)
+            used_blobs.setdefault(cache_key, (server["name"], set()))[1].update(digests)
+        pending[call] = (
+            cache_key,
+            server,
+            data,
+            time.monotonic(),
+            remote_call,
+            tracing.now(),
+            cost,
         )
-        port = 22 if wg else server.get("ssh_port", 22)
-        cache_key = f"{hostname}-{port}"
-        if cache_key not in ssh_cache:
-            key_path = path_to_config_file(server["ssh_key"]).resolve()
-            if not os.path.exists(key_path):
-                raise Exception(f"Can't find ssh key {key_path}")
-            username = server["ssh_user"]
+        in_flight += cost
+        select.add(call)
 
-            try:
-                connect = retry_call(
-                    router.ssh,
-                    exceptions=EofError,
-                    tries=3,
-                    fkwargs={
-                        "hostname": hostname,
-                        "port": port,
-                        "username": username,
-                        "identity_file": key_path.as_posix(),
-                        "check_host_keys": "accept",
-                        "python_path": "python3",
-                        "ssh_args": ["-o", "SendEnv DUMP_COMMAND"],
-                    },
-                )
-            except HostKeyError:
-                print(
-                    f"HostKeyError while trying to login to to {username}@{hostname}:{port}. Try running the following manually: ssh {username}@{hostname} -p {port} -i {key_path}"
-                )
-                raise
-            except StreamError:
-                print(
-                    f"Exception while trying to login to {username}@{hostname}:{port}"
-                )
-                raise
+    def start_waiting() -> None:
+        # Always lets one call run, however big it is
+        while waiting != []:
+            cache_key, server, remote_call = waiting[0]
+            cost = call_memory(blob_sizes, known(cache_key, remote_call))
+            if (
+                memory_budget is not None
+                and pending != {}
+                and in_flight + cost > memory_budget
+            ):
+                break
+            waiting.pop(0)
+            start_call(cache_key, server, remote_call)
 
-            if username != "root":
-                sudo = router.sudo(
-                    via=connect, python_path="python3", preserve_env=True
-                )
-                ssh_cache[cache_key] = sudo
-            else:
-                ssh_cache[cache_key] = connect
-        data = create_data(server=server)
-        calls.append(ssh_cache[cache_key].call_async(func, data, *args, **kwargs))
+    def queue_call(cache_key: str, server: ServerDict, remote_call: RemoteCall) -> None:
+        waiting.append((cache_key, server, remote_call))
+        start_waiting()
 
-    infos: List[Any] = []
-    errors: List[Exception] = []
-    for call in calls:
+    for cache_key, server in targets:
+        queue_call(cache_key, server, first_call)
+
+    while select:
+        message = select.get()
+        cache_key, server, call_data, started, remote_call, trace_start, cost = (
+            pending.pop(message.receiver)
+        )
+        in_flight -= cost
+        with tracing.track(server["name"]):
+            tracing.add_span(remote_call[0].__name__, "remote", trace_start)
         try:
-            info = call.get().unpickle()
-            if info is not None:
-                assert isinstance(info, Dict)
-                decode(cast(Dict[Union[str, bytes], Union[str, bytes]], info))
-            infos.append(info)
+            with memory.phase("receivers"):
+                info = message.unpickle()
         except Error as e:
-            print("Got error", e)
-            errors.append(e)
+            print(f"Got error from {server['name']}", e)
+            if fail_fast:
+                errors.append(e)
+                # Mitogen can't interrupt calls already running, so just stop waiting for them
+                select.close()
+                print(
+                    f"Failing fast, abandoning {[pending_server['name'] for (_, pending_server, *_) in pending.values()]}"
+                )
+                raise Exception(errors)
+            server_failed(server, e)
+            start_waiting()
+            continue
+        logging.info(
+            "%s finished in %.2fs" % (server["name"], time.monotonic() - started)
+        )
+        if info is not None:
+            assert isinstance(info, Dict)
+            decode(cast(Dict[Union[str, bytes], Union[str, bytes]], info))
+            if tracing.TRACE_KEY in info:
+                tracing.add_remote_events(
+                    server["name"],
+                    cast(Dict[str, Any], info).pop(tracing.TRACE_KEY),
+                    trace_start,
+                )
+            if profiling.PROFILE_KEY in info:
+                profiling.add_remote_stats(
+                    cast(Dict[str, Any], info).pop(profiling.PROFILE_KEY)
+                )
+        next_call = (
+            on_result(server, info, call_data) if on_result is not None else None
+        )
+        if next_call is None:
+            results[server["name"]] = info
+            start_waiting()
+        else:
+            queue_call(cache_key, server, next_call)
 
-    if len(errors) > 0:
+    # Rolling deploys carry on without the failed servers, unless there's too many of them
+    if rolling is None and len(errors) > 0:
         raise Exception(errors)
 
-    return {"infos": infos, "data": data}
+    finished = [server["name"] for _, server in targets if server["name"] in results]
+    return {
+        "infos": [results[name] for name in finished],
+        "data": data,
+        "servers": finished,
+    }
 
 
 def do(
-    data: Dict[str, Any], transmitmodules: TransmitModules, name: str, dry_run: bool
+    data: Dict[str, Any],
+    transmitmodules: TransmitModules,
+    name: str,
+    dry_run: bool,
+    waves: Optional[List[List[int]]] = None,
+    max_workers: int = 1,
+    trace: bool = False,
+    fingerprints: Optional[Dict[str, str]] = None,
+    force: bool = False,
+    profile: bool = False,
+    artifact_cache: Optional[Context] = None,
 ):
+    artifacts.set_controller(artifact_cache)
+    if trace:
+        tracing.set_tracing(True)
+    if profile:
+        profiling.set_profiling(True)
+    try:
+        os.environ[DRY_RUN_ENV] = str(dry_run)
+        payload = resolve_payload(data)
+        set_data(payload)
+        core.clear_selectors()
+        modules = makereal(transmitmodules)
+
+        bases = fingerprints if fingerprints is not None else {}
+        keys = [module_key(module) for module in transmitmodules]
+        stored: Dict[str, Fingerprint] = (
+            load_json_cache(FINGERPRINTS_FILENAME) if bases != {} else {}
+        )
+
+        def unchanged(key: str) -> bool:
+            if force or key not in bases or key not in stored:
+                return False
+            last = stored[key]
+            return (
+                input_fingerprint(bases[key], payload, last["reads"])
+                == last["fingerprint"]
+            )
+
+        to_run: List[int] = []
+        for index, key in enumerate(keys):
+            if unchanged(key):
+                logging.info("Skipping %s as nothing it uses has changed" % key)
+            else:
+                to_run.append(index)
+
+        def type_name(index: int) -> str:
+            return _module_type(modules[index]).__name__
+
+        def run_module(index: int) -> Dict[str, Any]:
+            key = keys[index]
+            # Only one profiler can be active at once, so waves are profiled as a whole instead
+            profiled = (
+                profiling.profiled(type_name(index))
+                if waves is None
+                else contextlib.nullcontext()
+            )
+            if key not in bases:
+                with profiled:
+                    return runfunc([modules[index]], name)
+            # Only counts as applied once it's succeeded
+            stored.pop(key, None)
+            with recording_reads() as reads, profiled:
+                result = runfunc([modules[index]], name)
+            if not dry_run:
+                stored[key] = {
+                    "fingerprint": input_fingerprint(bases[key], payload, reads),
+                    "reads": sorted([list(read) for read in reads]),
+                }
+            return result
+
+        results: Dict[int, Dict[str, Any]] = {}
+        try:
+            if waves is None:
+                for index in to_run:
+                    results[index] = run_module(index)
+            else:
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    for wave in waves:
+                        wave_to_run = [index for index in wave if index in to_run]
+                        if wave_to_run == []:
+                            continue
+                        # Modules that ran at the same time share their stats
+                        wave_name = "+".join(
+                            [type_name(index) for index in wave_to_run]
+                        )
+                        with profiling.profiled(wave_name):
+                            futures = dict(
+                                [
+                                    (index, executor.submit(run_module, index))
+                                    for index in wave_to_run
+                                ]
+                            )
+                            for index, future in futures.items():
+                                results[index] = future.result()
+        finally:
+            if bases != {} and not dry_run:
+                save_json_cache(FINGERPRINTS_FILENAME, stored)
+
+        ret: Dict[str, Any] = {}
+        for index in sorted(results.keys()):
+            for module_name, infos in results[index].items():
+                ret.setdefault(module_name, []).extend(infos)
+
+        if trace:
+            ret[tracing.TRACE_KEY] = tracing.take_events()
+        if profile:
+            ret[profiling.PROFILE_KEY] = profiling.take_stats()
+        return ret
+    finally:
+        if trace:
+            tracing.set_tracing(False)
+        if profile:
+            profiling.set_profiling(False)
+
+
+def _module_type(module: Module) -> ModuleType:
+    return module if isinstance(module, ModuleType) else module[0]
+
+
+def pipeline_batches(modules: Modules, parse_func: str) -> List[Modules]:
+    # What a `parse_func` writes may be needed by the modules after it, so a batch ends there
+    batches: List[Modules] = []
+    batch: List[Module] = []
+    for module in modules:
+        batch.append(module)
+        if getattr(_module_type(module), parse_func, None) is not None:
+            batches.append(batch)
+            batch = []
+    if batch != []:
+        batches.append(batch)
+    return batches
+
+
+# Each module to the modules it depends on, all in `maketransmit_single` form
+DependencyGraph = Dict[TransmitModule, List[TransmitModule]]
+
+
+# Number of modules to run at once on each server, and the graph of which can be run together
+parallel_modules = 1
+module_graph: DependencyGraph = {}
+
+
+def set_parallel(workers: int, graph: DependencyGraph) -> None:
+    global parallel_modules, module_graph
+    parallel_modules = workers
+    module_graph = graph
+
+
+def module_waves(modules: Modules, graph: DependencyGraph) -> List[List[int]]:
+    keys = [maketransmit_single(freeze_module(module)) for module in modules]
+    wave_of: Dict[TransmitModule, int] = {}
+    waves: List[List[int]] = []
+    wave_names: List[Set[str]] = []
+    for index, key in enumerate(keys):
+        wave = max(
+            [0] + [wave_of[dep] + 1 for dep in graph.get(key, []) if dep in wave_of]
+        )
+        name = _module_type(modules[index]).__name__
+        # The same module with different options shares globals, so can't run at once
+        while wave < len(waves) and name in wave_names[wave]:
+            wave += 1
+        if wave == len(waves):
+            waves.append([])
+            wave_names.append(set())
+        waves[wave].append(index)
+        wave_names[wave].add(name)
+        wave_of[key] = wave
+    return waves
+
+
+# Run modules even if nothing they use has changed since they were last applied
+force = False
+
+
+def set_force(new_force: bool) -> None:
+    global force
+    force = new_force
+
+
+def module_fingerprints(batch: Modules, parse_func: str) -> Dict[str, str]:
+    # Modules with a `parse_func` always run, as their results are needed
+    fingerprints: Dict[str, str] = {}
+    version = paracrine_version()
+    for module in batch:
+        module_type = _module_type(module)
+        if getattr(module_type, parse_func, None) is not None:
+            continue
+        if not getattr(module_type, "skip_unchanged", True):
+            continue
+        source_path: Optional[str] = getattr(module_type, "__file__", None)
+        if source_path is None:
+            continue
+        key = module_key(maketransmit_single(module))
+        fingerprints[key] = code_fingerprint(f"{key}\0{version}", module_type)
+    return fingerprints
+
+
+def needs_barrier(module: Module) -> bool:
+    return getattr(_module_type(module), "cross_host_data", True)
+
+
+# Each server works through a segment at its own pace
+def barrier_segments(batches: List[Modules]) -> List[List[Modules]]:
+    segments: List[List[Modules]] = []
+    for batch in batches:
+        if segments != [] and not any([needs_barrier(module) for module in batch]):
+            segments[-1].append(batch)
+        else:
+            segments.append([batch])
+    return segments
+
+
+def parse_info(
+    batch: Modules,
+    parse_func: str,
+    info: Dict[str, Any],
+    data: Mapping[str, object],
+    dry_run: bool,
+) -> None:
     os.environ[DRY_RUN_ENV] = str(dry_run)
-    set_data(data)
-    modules = makereal(transmitmodules)
-    return runfunc(modules, name)
+    with memory.phase(parse_func):
+        runfunc(batch, parse_func, info, data)
+    for module_name in info:
+        for per_node in info[module_name]:
+            if not isinstance(per_node, Dict):
+                continue
+            if "selector" not in per_node:
+                continue
+            core.add_selectors(cast(Dict[str, str], per_node["selector"]))
+
+
+def run_segment(
+    router: Router,
+    servers: list[str],
+    segment: List[Modules],
+    local_func: str,
+    run_func: str,
+    parse_func: str,
+    dry_run: bool,
+) -> None:
+    calls: Dict[int, RemoteCall] = {}
+    stage_of: Dict[str, int] = {}
+
+    def remote_call(index: int) -> RemoteCall:
+        batch = segment[index]
+        if index not in calls:
+            runfunc(batch, local_func)
+        # Anything picked so far needs to be in the configs sent with this call
+        core.flush_selectors()
+        if index in calls:
+            return calls[index]
+        args: Tuple[Any, ...] = (maketransmit(batch), run_func, dry_run)
+        if parallel_modules > 1:
+            args += (module_waves(batch, module_graph), parallel_modules)
+        kwargs: Dict[str, Any] = {
+            "fingerprints": module_fingerprints(batch, parse_func),
+            "force": force,
+        }
+        if tracing.enabled:
+            kwargs["trace"] = True
+        if profiling.enabled:
+            kwargs["profile"] = True
+        artifact_cache = artifacts.controller(router)
+        if artifact_cache is not None:
+            kwargs["artifact_cache"] = artifact_cache
+        calls[index] = (do, args, kwargs)
+        return calls[index]
+
+    if len(segment) == 1:
+        infos = run_on_servers(router, servers, remote_call(0))
+        for server_name, info in zip(infos["servers"], infos["infos"]):
+            with tracing.track(server_name):
+                parse_info(segment[0], parse_func, info, infos["data"], dry_run)
+        core.flush_selectors()
+        return
+
+    def on_result(
+        server: ServerDict, info: Any, data: Mapping[str, object]
+    ) -> Optional[RemoteCall]:
+        index = stage_of.get(server["name"], 0)
+        with tracing.track(server["name"]):
+            parse_info(segment[index], parse_func, info, data, dry_run)
+        if index + 1 == len(segment):
+            return None
+        stage_of[server["name"]] = index + 1
+        return remote_call(index + 1)
+
+    run_on_servers(router, servers, remote_call(0), on_result)
+    core.flush_selectors()
 
 
 def internal_runner(
@@ -160,74 +833,121 @@ def internal_runner(
     parse_func: str,
     dry_run: bool,
 ) -> None:
-    for module in modules:
-        runfunc([module], local_func)
-        infos = main(router, servers, do, maketransmit([module]), run_func, dry_run)
-        for info in infos["infos"]:
-            os.environ[DRY_RUN_ENV] = str(dry_run)
-            runfunc([module], parse_func, info, infos["data"])
-            for module_name in info:
-                for per_node in info[module_name]:
-                    if not isinstance(per_node, Dict):
-                        continue
-                    if "selector" not in per_node:
-                        continue
-                    config_path = other_config_file("selectors.json")
-                    if os.path.exists(config_path):
-                        selector_config: Dict[str, object] = json.load(
-                            open(config_path)
-                        )
-                    else:
-                        selector_config = {}
-                    merge(
-                        selector_config, cast(Dict[str, object], per_node["selector"])
-                    )
-                    selector_config = dict(sorted(selector_config.items()))
-                    set_file_contents(
-                        config_path, json.dumps(selector_config, indent=2)
-                    )
-
-
-def generate_dependencies(modules: Modules):
-    tree: Dict[str, List[Module]] = {}
-    mapping: Dict[str, Module] = {}
-    checked: List[Module] = []
-    needs_dependencies = list(modules) + [core]
-    modules = []
+    batches = pipeline_batches(modules, parse_func)
+    for segment in barrier_segments(batches):
+        run_segment(router, servers, segment, local_func, run_func, parse_func, dry_run)
+
+
+def _dependency_inputs() -> Optional[str]:
+    # Things other than the modules themselves that "dependencies" functions look at
+    try:
+        inventory = get_config()
+    except AssertionError:
+        return None
+    local_config = (
+        read_cached_text(CONFIG_NAME) if os.path.exists(CONFIG_NAME) else None
+    )
+    return json.dumps([inventory, local_config], sort_keys=True, default=str)
+
+
+_dependency_cache: Dict[
+    Tuple[Tuple[TransmitModule, ...], Optional[str]],
+    Tuple[List[Module], DependencyGraph],
+] = {}
+
+
+def _discover_dependencies(
+    modules: Modules,
+) -> Tuple[List[TransmitModule], Dict[TransmitModule, Module], DependencyGraph]:
+    discovered: List[TransmitModule] = []
+    mapping: Dict[TransmitModule, Module] = {}
+    graph: DependencyGraph = {}
+    needs_dependencies = [freeze_module(module) for module in list(modules) + [core]]
+    seen = set([maketransmit_single(module) for module in needs_dependencies])
     while len(needs_dependencies) > 0:
-        check = freeze_module(needs_dependencies.pop())
-        checked.append(check)
-        key = str(maketransmit_single(check))
-        tree[key] = []
+        check = needs_dependencies.pop()
+        key = maketransmit_single(check)
+        if key in graph:
+            continue
+        discovered.append(key)
         mapping[key] = check
+        graph[key] = []
         new_dependencies = cast(
             Dict[str, List[Modules]], runfunc([check], "dependencies")
         )
         for item in new_dependencies.values():
             for new_dependency in item[0]:
                 new_dependency = freeze_module(new_dependency)
-                tree[key].append(new_dependency)
-                if new_dependency in needs_dependencies or new_dependency in checked:
+                new_key = maketransmit_single(new_dependency)
+                graph[key].append(new_key)
+                if new_key in seen:
                     continue
+                seen.add(new_key)
                 needs_dependencies.append(new_dependency)
 
-    count = 0
-    while len(checked) > 0:
-        count += 1
-        if count == 100:
-            raise Exception((modules, checked))
-        for key, value in tree.items():
-            mapped = mapping[key]
-            if mapped in modules:
-                continue
-            for dep in value:
-                if dep not in modules:
-                    break
-            else:
-                modules.append(mapped)
-                checked.remove(mapped)
+    return discovered, mapping, graph
+
+
+def _describe_cycle(path: List[TransmitModule], repeated: TransmitModule) -> str:
+    cycle = path[path.index(repeated) :] + [repeated]
+    return " -> ".join([str(unfreeze_module(key)) for key in cycle])
+
+
+def resolve_dependencies(modules: Modules) -> Tuple[List[Module], DependencyGraph]:
+    inputs = _dependency_inputs()
+    cache_key = (
+        tuple([maketransmit_single(freeze_module(m)) for m in modules]),
+        inputs,
+    )
+    if cache_key in _dependency_cache:
+        cached, cached_graph = _dependency_cache[cache_key]
+        return list(cached), cached_graph
+
+    discovered, mapping, graph = _discover_dependencies(modules)
+    position = dict([(key, index) for index, key in enumerate(discovered)])
 
-    return modules
+    # Each module goes in the earliest round after all its dependencies
+    rounds: Dict[TransmitModule, int] = {}
+    for root in discovered:
+        if root in rounds:
+            continue
+        path: List[TransmitModule] = [root]
+        on_path = set([root])
+        pending = [iter(graph[root])]
+        while len(pending) > 0:
+            dependency = next(pending[-1], None)
+            if dependency is None:
+                key = path.pop()
+                on_path.remove(key)
+                pending.pop()
+                rounds[key] = max(
+                    [1]
+                    + [
+                        rounds[dep] + (1 if position[dep] > position[key] else 0)
+                        for dep in graph[key]
+                    ]
+                )
+            elif dependency in on_path:
+                raise Exception(
+                    f"Dependency cycle: {_describe_cycle(path, dependency)}"
+                )
+            elif dependency not in rounds:
+                path.append(dependency)
+                on_path.add(dependency)
+                pending.append(iter(graph[dependency]))
+
+    by_round: List[List[Module]] = [[] for _ in range(max(rounds.values()))]
+    for key in discovered:
+        by_round[rounds[key] - 1].append(mapping[key])
+    ret: List[Module] = [module for round in by_round for module in round]
+
+    if inputs is not None:
+        _dependency_cache[cache_key] = (list(ret), graph)
+    return ret, graph
+
+
+def generate_dependencies(modules: Modules) -> List[Module]:
+    return resolve_dependencies(modules)[0]
 
 
 SERVER_FILTER = Callable[[ServerDict], bool]
@@ -251,39 +971,215 @@ def server_role_picker(name: str) -> SERVER_FILTER:
     return inner
 
 
-def run(
-    args: List[str],
-    modules: Union[Modules, dict[Callable[[ServerDict], bool], Modules]],
-    log_level: int = logging.INFO,
+def server_limit_filter(patterns: List[str]) -> SERVER_FILTER:
+    # Names (with globs e.g. "web-*") or "role:<name>" for a role that's already been picked
+    roles = [
+        pattern[len("role:") :] for pattern in patterns if pattern.startswith("role:")
+    ]
+    known_roles = core.selectors() if roles != [] else {}
+    unknown_roles = [role for role in roles if role not in known_roles]
+    if unknown_roles != []:
+        raise Exception(
+            f"--limit has unknown roles {unknown_roles}. Known roles are {sorted(known_roles.keys())}"
+        )
+    role_servers = set([known_roles[role] for role in roles])
+    names = [pattern for pattern in patterns if not pattern.startswith("role:")]
+
+    def inner(server: ServerDict) -> bool:
+        return server["name"] in role_servers or any(
+            [fnmatch.fnmatchcase(server["name"], name) for name in names]
+        )
+
+    return inner
+
+
+def module_matches(module: Module, patterns: List[str]) -> bool:
+    # Globs, or parts of the name e.g. "redis" for everything in `paracrine.services.redis`
+    name = _module_type(module).__name__
+    return any(
+        [
+            fnmatch.fnmatchcase(name, pattern) or f".{pattern}." in f".{name}."
+            for pattern in patterns
+        ]
+    )
+
+
+def select_modules(
+    modules: List[Module],
+    graph: DependencyGraph,
+    only: Optional[List[str]],
+    skip: Optional[List[str]],
+) -> List[Module]:
+    keys = [maketransmit_single(freeze_module(module)) for module in modules]
+    if only is None:
+        wanted = set(keys)
+    else:
+        to_check = [
+            key for key, module in zip(keys, modules) if module_matches(module, only)
+        ]
+        if to_check == []:
+            raise Exception(f"--only {','.join(only)} doesn't match any modules")
+        to_check.extend(
+            [key for key, module in zip(keys, modules) if _module_type(module) == core]
+        )
+        wanted: Set[TransmitModule] = set()
+        while len(to_check) > 0:
+            key = to_check.pop()
+            if key in wanted:
+                continue
+            wanted.add(key)
+            to_check.extend(graph.get(key, []))
+
+    return [
+        module
+        for key, module in zip(keys, modules)
+        if key in wanted and (skip is None or not module_matches(module, skip))
+    ]
+
+
+def comma_list(value: str) -> List[str]:
+    return [item for item in value.split(",") if item != ""]
+
+
+def batch_size_arg(value: str) -> str:
+    try:
+        batch_count(value, 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"'{value}' isn't a count or percentage of servers"
+        )
+    return value
+
+
+ModulesArg = Union[Modules, dict[Callable[[ServerDict], bool], Modules]]
+
+
+def prune_unused_blobs() -> None:
+    """Removes the blobs this run didn't use from each server it succeeded on"""
+    calls = [
+        (
+            cache_key,
+            server_name,
+            ssh_cache[cache_key].call_async(prune_blobs, sorted(used)),
+        )
+        for cache_key, (server_name, used) in used_blobs.items()
+        if cache_key in ssh_cache and server_name not in failed_servers
+    ]
+    for cache_key, server_name, call in calls:
+        try:
+            call.get()
+        except Error as e:
+            print(f"Unable to prune blobs on {server_name}", e)
+            continue
+        known_blobs[cache_key].intersection_update(used_blobs[cache_key][1])
+
+
+def deploy(
+    router: Router,
+    parsed_args: argparse.Namespace,
+    modules: ModulesArg,
+    health_check: Optional[HealthCheck] = None,
 ):
-    logging.basicConfig()
-    logging.root.setLevel(log_level)
+    tracing.set_tracing(parsed_args.trace is not None)
+    profiling.set_profiling(parsed_args.profile is not None)
+    memory.set_memory_report(parsed_args.memory_report)
+    set_memory_budget(
+        None
+        if parsed_args.memory_budget is None
+        else parsed_args.memory_budget * 1024 * 1024
+    )
+    # Files may have changed since the last deploy in this process (e.g. in the agent)
+    clear_file_cache()
+    clear_digests()
+    used_blobs.clear()
+    try:
+        _deploy(router, parsed_args, modules, health_check)
+        prune_unused_blobs()
+    finally:
+        clear_file_cache()
+        clear_digests()
+        if parsed_args.trace is not None:
+            tracing.write_trace(parsed_args.trace)
+            print(f"Wrote trace to {parsed_args.trace}")
+            tracing.set_tracing(False)
+        if parsed_args.profile is not None:
+            profiling.write_profiles(parsed_args.profile)
+            print(f"Wrote profiles to {parsed_args.profile}")
+            profiling.set_profiling(False)
+        if parsed_args.memory_report:
+            print("\n".join(memory.report()))
+            memory.set_memory_report(False)
 
-    parser = argparse.ArgumentParser(prog="paracrine")
-    parser.add_argument("-i", "--inventory-path", dest="inventory_path", required=True)
-    parser.add_argument("-a", "--apply", default=False, action="store_true")
-    parsed_args = parser.parse_args(args)
+
+def _deploy(
+    router: Router,
+    parsed_args: argparse.Namespace,
+    modules: ModulesArg,
+    health_check: Optional[HealthCheck] = None,
+):
     set_config(parsed_args.inventory_path)
+    core.clear_selectors()
+    if parsed_args.batch_size is not None:
+        set_rolling(
+            {
+                "batch_size": parsed_args.batch_size,
+                "max_failures": parsed_args.max_failures,
+                "health_check": health_check,
+            }
+        )
+    else:
+        set_rolling(None)
 
     all_servers = get_config()["servers"]
 
+    graph: DependencyGraph = {}
     if isinstance(modules, dict):
-        module_mapping = dict(
-            [(k, generate_dependencies(v)) for (k, v) in modules.items()]
-        )
+        module_mapping: Dict[SERVER_FILTER, Modules] = {}
+        for server_filter, filter_modules in modules.items():
+            module_mapping[server_filter], filter_graph = resolve_dependencies(
+                filter_modules
+            )
+            graph.update(filter_graph)
         all_modules: Modules = []
         for modules in module_mapping.values():
             for module in modules:
                 if module not in all_modules:
                     all_modules.append(module)
     else:
-        all_modules = generate_dependencies(modules)
+        all_modules, graph = resolve_dependencies(modules)
         module_mapping = {ALL_SERVERS: all_modules}
+    if parsed_args.only is not None or parsed_args.skip is not None:
+        selected = select_modules(
+            list(all_modules), graph, parsed_args.only, parsed_args.skip
+        )
+        all_modules = selected
+        module_mapping = dict(
+            [
+                (
+                    server_filter,
+                    [module for module in filter_modules if module in selected],
+                )
+                for server_filter, filter_modules in module_mapping.items()
+            ]
+        )
+    set_parallel(parsed_args.parallel, graph)
+    set_fail_fast(parsed_args.fail_fast)
+    set_force(parsed_args.force)
+    # Nothing is downloaded on dry runs
+    artifacts.serve(router, parsed_args.artifact_cache and parsed_args.apply)
 
     module_descriptions = dict(
         [(module, maketransmit_single(module)) for module in all_modules]
     )
 
+    if parsed_args.limit is not None:
+        limit = server_limit_filter(parsed_args.limit)
+        all_servers = [server for server in all_servers if limit(server)]
+        if all_servers == []:
+            raise Exception(
+                f"--limit {','.join(parsed_args.limit)} doesn't match any servers"
+            )
+
     all_server_names = set([server["name"] for server in all_servers])
     server_modules: dict[str, list[TransmitModule]] = dict(
         [(name, []) for name in all_server_names]
@@ -317,16 +1213,22 @@ def run(
 
     print("")
 
-    def do_runs(router: Router) -> None:
+    def run_modules(batch: Set[str]) -> None:
         to_run_modules: list[Module] = []
-        to_run_servers = []
+        to_run_servers: list[str] = []
 
         for module in all_modules:
             module_description = module_descriptions[module]
             if module_description not in modules_for_server:
                 continue
 
-            wanted_servers = sorted(set(modules_for_server[module_description]))
+            wanted_servers = sorted(
+                set(modules_for_server[module_description])
+                .intersection(batch)
+                .difference(failed_servers.keys())
+            )
+            if wanted_servers == []:
+                continue
             if to_run_servers != [] and to_run_servers != wanted_servers:
                 internal_runner(
                     router,
@@ -342,14 +1244,156 @@ def run(
             to_run_servers = wanted_servers
             to_run_modules.append(unfreeze_module(module))
 
-        internal_runner(
-            router,
-            to_run_servers,
-            to_run_modules,
-            "local",
-            "run",
-            "parse_return",
-            not parsed_args.apply,
+        if to_run_modules != []:
+            internal_runner(
+                router,
+                to_run_servers,
+                to_run_modules,
+                "local",
+                "run",
+                "parse_return",
+                not parsed_args.apply,
+            )
+
+    if rolling is None:
+        run_modules(all_server_names)
+        return
+
+    # Each batch gets all of its modules before the next batch starts
+    server_names = [server["name"] for server in all_servers]
+    batch_size = batch_count(rolling["batch_size"], len(server_names))
+    batches = [
+        server_names[start : start + batch_size]
+        for start in range(0, len(server_names), batch_size)
+    ]
+    for index, batch in enumerate(batches):
+        if len(batches) > 1:
+            print(f"Rolling batch {index + 1}/{len(batches)}: {batch}")
+        run_modules(set(batch))
+        if index == len(batches) - 1:
+            break
+        succeeded = [name for name in batch if name not in failed_servers]
+        health_check = rolling["health_check"]
+        if health_check is not None and not health_check(succeeded):
+            raise Exception(f"Health check failed after {succeeded}")
+
+    if failed_servers != {}:
+        print(
+            f"Failed on {sorted(failed_servers.keys())}, which is within the maximum of {rolling['max_failures']} failures"
         )
 
-    run_with_router(do_runs)
+
+def run(
+    args: List[str],
+    modules: ModulesArg,
+    log_level: int = logging.INFO,
+    health_check: Optional[HealthCheck] = None,
+):
+    logging.basicConfig()
+    logging.root.setLevel(log_level)
+
+    parser = argparse.ArgumentParser(prog="paracrine")
+    parser.add_argument("-i", "--inventory-path", dest="inventory_path", required=True)
+    parser.add_argument("-a", "--apply", default=False, action="store_true")
+    parser.add_argument(
+        "--agent",
+        default=False,
+        action="store_true",
+        help="Stay running and keep connections open for later runs with the same main file and inventory to use. "
+        "Changes to module code need an agent restart to be picked up",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=batch_size_arg,
+        help="Roll out to this many servers at a time, either a count or a percentage e.g. 25%%",
+    )
+    parser.add_argument(
+        "--max-failures",
+        type=int,
+        default=0,
+        help="Keep rolling out to more batches until there's more than this many failed servers",
+    )
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        default=1,
+        help="Run up to this many modules at once on each server, when they don't depend on each other",
+    )
+    parser.add_argument(
+        "--fail-fast",
+        default=False,
+        action="store_true",
+        help="Stop as soon as any server fails, rather than waiting for the others to finish",
+    )
+    parser.add_argument(
+        "--limit",
+        type=comma_list,
+        action="extend",
+        help="Only run on these servers. Comma-separated names, globs (e.g. web-*) or role:<name> for the server already picked for a role",
+    )
+    parser.add_argument(
+        "--only",
+        type=comma_list,
+        action="extend",
+        help="Only run these modules (and what they depend on). Comma-separated module names, globs or the end of a name e.g. ntp",
+    )
+    parser.add_argument(
+        "--skip",
+        type=comma_list,
+        action="extend",
+        help="Don't run these modules. Same format as --only",
+    )
+    parser.add_argument(
+        "--force",
+        default=False,
+        action="store_true",
+        help="Run all modules, even ones where nothing they use has changed since they were last applied",
+    )
+    parser.add_argument(
+        "--no-artifact-cache",
+        dest="artifact_cache",
+        default=True,
+        action="store_false",
+        help="Have each server download artifacts itself, rather than fetching each once on this controller and sending it to the servers",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="PATH",
+        help="Write timings of each module on each server to PATH, in Chrome trace-event format for Perfetto",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="DIR",
+        help="Profile each module's run on the servers, and write the stats merged across servers to DIR, "
+        "as a .pstats and a .folded (collapsed stacks, for flame graphs) file per module. "
+        "With --parallel, modules run at the same time share one file e.g. a+b.pstats",
+    )
+    parser.add_argument(
+        "--memory-report",
+        default=False,
+        action="store_true",
+        help="Report the peak memory use of this controller, and how much of it went on building payloads, "
+        "pickling them, unpickling results and parse_return",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        metavar="MB",
+        help="Limit how many servers are sent calls at once, to keep the estimated memory for calls in flight under this",
+    )
+    parsed_args = parser.parse_args(args)
+    socket_path = agent.socket_path(parsed_args.inventory_path)
+
+    if parsed_args.agent:
+
+        def serve(router: Router) -> None:
+            agent.serve(
+                socket_path,
+                lambda agent_args: deploy(
+                    router, parser.parse_args(agent_args), modules, health_check
+                ),
+            )
+
+        run_with_router(serve)
+    elif not agent.attach(socket_path, args):
+        run_with_router(deploy, parsed_args, modules, health_check)
@@ -1,11 +1,26 @@
+import hashlib
 import json
+import math
 import os
 import socket
+import time
 from pathlib import Path
-from typing import Dict, List, TypedDict, cast
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Mapping,
+    NotRequired,
+    Optional,
+    TypedDict,
+    TypeVar,
+    cast,
+)
 
 from paracrine import is_dry_run
 
+from ..helpers.cache import load_json_cache, save_json_cache
 from ..helpers.config import (
     ServerDict,
     add_return_data,
@@ -24,6 +39,7 @@ from ..helpers.fs import (
     make_directory,
     run_command,
     set_file_contents,
+    write_atomic,
 )
 from ..helpers.users import in_vagrant, users
 
@@ -32,40 +48,83 @@ def is_wireguard():
     return os.path.exists("/etc/wireguard")
 
 
-def hash_fn(key: str, count: int) -> int:
-    return sum(bytearray(key.encode("utf-8"))) % count
+def rendezvous_score(key: str, host: ServerDict) -> float:
+    raw = hashlib.sha256(f"{host['name']}:{key}".encode("utf-8")).digest()
+    # Map to (0, 1) so the log is always defined and negative
+    uniform = (int.from_bytes(raw[:8], "big") + 1) / (2**64 + 1)
+    return -host.get("selector_weight", 1.0) / math.log(uniform)
+
+
+def rendezvous_index(key: str, hosts: List[ServerDict]) -> int:
+    """Picks a host for `key` with weighted rendezvous hashing, so adding or removing a host only
+    moves the keys that host wins or held"""
+    scores = [rendezvous_score(key, host) for host in hosts]
+    return scores.index(max(scores))
+
+
+SELECTORS_FILENAME = "selectors.json"
+
+# Run-scoped registry of which server is picked for each role. Loaded once from the selectors
+# config, with new picks batched up until `flush_selectors`
+_selectors: Optional[Dict[str, str]] = None
+_new_selectors: Dict[str, str] = {}
+
+
+def clear_selectors() -> None:
+    global _selectors, _new_selectors
+    _selectors = None
+    _new_selectors = {}
+
+
+def selectors() -> Dict[str, str]:
+    global _selectors
+    if _selectors is None:
+        try:
+            if in_local():
+                _selectors = cast(
+                    Dict[str, str],
+                    json.load(open(other_config_file(SELECTORS_FILENAME))),
+                )
+            else:
+                _selectors = cast(Dict[str, str], other_config(SELECTORS_FILENAME))
+        except (KeyError, FileNotFoundError):
+            _selectors = {}
+    return _selectors
+
+
+def add_selectors(new_selectors: Mapping[str, str]) -> None:
+    selectors().update(new_selectors)
+    _new_selectors.update(new_selectors)
+
+
+def flush_selectors() -> None:
+    """Writes out any new selectors picked locally since the last flush. Dry runs only keep
+    them in memory"""
+    if _new_selectors == {} or is_dry_run():
+        return
+    path = Path(other_config_file(SELECTORS_FILENAME))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    write_atomic(
+        path, json.dumps(selectors(), indent=2, sort_keys=True).encode("utf-8")
+    )
+    _new_selectors.clear()
 
 
 def _index_fn(name: str) -> ServerDict:
     hosts = get_config()["servers"]
 
-    selectors_filename = "selectors.json"
+    existing = selectors().get(name)
+    if existing is not None:
+        return [host for host in hosts if host["name"] == existing][0]
 
-    try:
-        if in_local():
-            existing_selectors = json.load(open(other_config_file(selectors_filename)))
-        else:
-            existing_selectors = other_config(selectors_filename)
-        return [host for host in hosts if host["name"] == existing_selectors[name]][0]
-    except (KeyError, FileNotFoundError) as exception:
-        index = hash_fn(name, len(hosts))
-        if in_local():
-            if isinstance(exception, FileNotFoundError):
-                existing_selectors = {}
-            else:
-                existing_selectors = json.load(
-                    open(other_config_file(selectors_filename))
-                )
-            existing_selectors[name] = hosts[index]["name"]
-            json.dump(
-                existing_selectors,
-                open(other_config_file(selectors_filename), "w"),
-                indent=2,
-                sort_keys=True,
-            )
-        else:
-            add_return_data({"selector": {name: hosts[index]["name"]}})
-        return hosts[index]
+    index = rendezvous_index(name, hosts)
+    if in_local():
+        add_selectors({name: hosts[index]["name"]})
+    else:
+        # Keep it for the rest of this call, and send it back to be recorded
+        selectors()[name] = hosts[index]["name"]
+        add_return_data({"selector": {name: hosts[index]["name"]}})
+    return hosts[index]
 
 
 # Use this host for a given service
@@ -87,38 +146,106 @@ class CoreReturn(TypedDict):
     server_name: str
     network_devices: str
     external_ip: str
+    facts_hash: NotRequired[str]
+
+
+FACTS_FILENAME = "facts.json"
+
+# Seconds each fact is cached for on the servers
+FACT_TTLS: Dict[str, int] = {
+    "iproute2": 24 * 60 * 60,
+    "users": 60 * 60,
+    "groups": 60 * 60,
+}
+
+# Files that invalidate a cached fact as soon as they change
+FACT_SIGNALS: Dict[str, List[str]] = {
+    "iproute2": ["/var/lib/dpkg/status"],
+    "users": ["/etc/passwd"],
+    "groups": ["/etc/group"],
+}
+
+
+class Fact(TypedDict):
+    value: Any
+    expires: float
+    signals: Dict[str, Optional[int]]
+
+
+T = TypeVar("T")
+
+
+def _fact_signals(name: str) -> Dict[str, Optional[int]]:
+    signals: Dict[str, Optional[int]] = {}
+    for path in FACT_SIGNALS[name]:
+        try:
+            signals[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            signals[path] = None
+    return signals
+
+
+def cached_fact(facts: Dict[str, Fact], name: str, compute: Callable[[], T]) -> T:
+    signals = _fact_signals(name)
+    fact = facts.get(name)
+    if (
+        fact is not None
+        and fact["expires"] > time.time()
+        and fact["signals"] == signals
+    ):
+        return fact["value"]
+    value = compute()
+    facts[name] = {
+        "value": value,
+        "expires": time.time() + FACT_TTLS[name],
+        "signals": signals,
+    }
+    return value
+
+
+def _iproute2_installed() -> bool:
+    changed = apt_install(["iproute2"])
+    # Dry runs don't actually install anything
+    return not (changed and is_dry_run())
+
+
+def _network_devices() -> str:
+    ip_json = run_command("ip -j address", dry_run_safe=True)
+    if ip_json == "":  # because dry-run and no "ip" command
+        ip_json = "{}"
+    raw_network_devices = [
+        network for network in json.loads(ip_json) if network.get("master") != "docker0"
+    ]
+    remove_attrs = ["ifindex", "link_index"]
+    remove_addr_attrs = ["valid_life_time", "preferred_life_time"]
+    for device in cast(List[Dict[str, object]], raw_network_devices):
+        for remove_attr in remove_attrs:
+            if remove_attr in device:
+                del device[remove_attr]
+        for addr in cast(List[Dict[str, object]], device["addr_info"]):
+            for remove_attr in remove_addr_attrs:
+                if remove_attr in addr:
+                    del addr[remove_attr]
+    return json.dumps(raw_network_devices)
 
 
 def run() -> CoreReturn:
-    apt_install(["iproute2"])
+    facts: Dict[str, Fact] = load_json_cache(FACTS_FILENAME)
+    if not cached_fact(facts, "iproute2", _iproute2_installed):
+        del facts["iproute2"]
 
     data = {
         "hostname": socket.gethostname(),
-        "users": users(force_load=True),
-        "groups": run_command("getent group", dry_run_safe=True),
+        "users": cached_fact(facts, "users", lambda: users(force_load=True)),
+        "groups": cached_fact(
+            facts, "groups", lambda: run_command("getent group", dry_run_safe=True)
+        ),
         "server_name": host()["name"],
     }
     try:
-        ip_json = run_command("ip -j address", dry_run_safe=True)
-        if ip_json == "":  # because dry-run and no "ip" command
-            ip_json = "{}"
-        raw_network_devices = [
-            network
-            for network in json.loads(ip_json)
-            if network.get("master") != "docker0"
-        ]
-        remove_attrs = ["ifindex", "link_index"]
-        remove_addr_attrs = ["valid_life_time", "preferred_life_time"]
-        for device in cast(List[Dict[str, object]], raw_network_devices):
-            for remove_attr in remove_attrs:
-                if remove_attr in device:
-                    del device[remove_attr]
-            for addr in cast(List[Dict[str, object]], device["addr_info"]):
-                for remove_attr in remove_addr_attrs:
-                    if remove_attr in addr:
-                        del addr[remove_attr]
-        data["network_devices"] = json.dumps(raw_network_devices)
-
+        # Not cached, as modules (e.g. wireguard) add interfaces and addresses mid-run, and
+        # there's no cheap way to tell that's happened
+        data["network_devices"] = _network_devices()
     except MissingCommandException:
         if is_dry_run():
             data["network_devices"] = "{}"
@@ -148,9 +275,17 @@ def run() -> CoreReturn:
             )
         set_file_contents(ip_file, json.dumps(data["external_ip"]))
 
+    save_json_cache(FACTS_FILENAME, facts)
+    data["facts_hash"] = hashlib.sha256(
+        json.dumps(data, sort_keys=True).encode("utf-8")
+    ).hexdigest()
     return cast(CoreReturn, data)
 
 
+def facts_hash_file(name: str) -> str:
+    return config_path() + f"/.facts-{name}"
+
+
 def parse_return(infos: List[CoreReturn]) -> None:
     if len(infos) == 0:
         return
@@ -158,6 +293,16 @@ def parse_return(infos: List[CoreReturn]) -> None:
     networks = json.loads(info["network_devices"])
     name = info["server_name"]
     make_directory(config_path())
+    hash_file = Path(facts_hash_file(name))
+    if (
+        "facts_hash" in info
+        and hash_file.exists()
+        and hash_file.read_text() == info["facts_hash"]
+        and os.path.exists(network_config_file(name))
+        and os.path.exists(other_config_file(name))
+    ):
+        # Nothing's changed since these were last written
+        return
     set_file_contents(network_config_file(name), json.dumps(networks, indent=2))
 
     other = {
@@ -176,3 +321,5 @@ def parse_return(infos: List[CoreReturn]) -> None:
     set_file_contents(
         other_config_file(name), json.dumps(other, indent=2, sort_keys=True)
     )
+    if "facts_hash" in info:
+        set_file_contents(hash_file, info["facts_hash"])
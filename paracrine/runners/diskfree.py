@@ -5,6 +5,10 @@ options: Dict[str, object] = {}
 
 MIN_DISK_FREE_KEY = "MIN_DISK_FREE"
 
+cross_host_data = False
+# Disk usage changes without anything paracrine sees changing
+skip_unchanged = False
+
 
 # Example usage: (diskfree, {diskfree.MIN_DISK_FREE_KEY: 10})
 def run():
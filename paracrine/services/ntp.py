@@ -1,6 +1,8 @@
 from ..helpers.debian import apt_install
 from ..helpers.systemd import systemd_set
 
+cross_host_data = False
+
 
 def run():
     apt_install(["ntp"])
@@ -11,6 +11,9 @@ from .common import get_master_ip
 
 options: Dict[str, object] = {}
 
+# Checks the live replication state
+skip_unchanged = False
+
 
 def dependencies() -> Modules:
     return [(node, options), check_master]
@@ -0,0 +1,109 @@
+"""Timing traces of runs.
+
+With tracing on, each `local`, `run` and `parse_return` call of every module, the connections to
+each server and every command run are recorded. `write_trace` saves them in the Chrome
+trace-event format, which can be opened in https://ui.perfetto.dev or chrome://tracing. Each
+server gets its own track, and everything done by the controller not for a particular server is
+under "controller".
+"""
+
+import contextlib
+import json
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+CONTROLLER = "controller"
+
+# Key used to send the events from a remote call back with its results
+TRACE_KEY = "__paracrine_trace__"
+
+TraceEvent = Dict[str, Any]
+
+enabled = False
+_origin = time.perf_counter()
+_events: List[TraceEvent] = []
+_lock = threading.Lock()
+_track = threading.local()
+
+
+def set_tracing(new_enabled: bool) -> None:
+    """Turns tracing on or off, dropping any events so far and restarting the clock"""
+    global enabled, _origin
+    enabled = new_enabled
+    _origin = time.perf_counter()
+    with _lock:
+        _events.clear()
+
+
+def now() -> float:
+    """Microseconds since tracing was last turned on"""
+    return (time.perf_counter() - _origin) * 1_000_000
+
+
+@contextlib.contextmanager
+def track(name: str) -> Iterator[None]:
+    """Records spans in this thread under the track for `name` (normally a server name)"""
+    previous: Optional[str] = getattr(_track, "name", None)
+    _track.name = name
+    try:
+        yield
+    finally:
+        _track.name = previous
+
+
+def add_span(name: str, category: str, start: float, **args: object) -> None:
+    if not enabled:
+        return
+    event: TraceEvent = {
+        "name": name,
+        "cat": category,
+        "ph": "X",
+        "ts": start,
+        "dur": now() - start,
+        "pid": getattr(_track, "name", None) or CONTROLLER,
+        "tid": threading.get_ident(),
+        "args": args,
+    }
+    with _lock:
+        _events.append(event)
+
+
+@contextlib.contextmanager
+def span(name: str, category: str, **args: object) -> Iterator[None]:
+    start = now()
+    try:
+        yield
+    finally:
+        add_span(name, category, start, **args)
+
+
+def take_events() -> List[TraceEvent]:
+    with _lock:
+        events = list(_events)
+        _events.clear()
+    return events
+
+
+def add_remote_events(host: str, events: List[TraceEvent], offset: float) -> None:
+    """Adds events from a remote call to `host`. Their times are relative to the start of
+    that call, so `offset` is when (from `now`) the call was made"""
+    for event in events:
+        event["pid"] = host
+        event["ts"] += offset
+    with _lock:
+        _events.extend(events)
+
+
+def write_trace(path: str) -> None:
+    events = take_events()
+    pids: Dict[str, int] = {CONTROLLER: 0}
+    for event in events:
+        pids.setdefault(event["pid"], len(pids))
+    trace: List[TraceEvent] = [
+        {"name": "process_name", "ph": "M", "pid": pid, "args": {"name": name}}
+        for name, pid in pids.items()
+    ]
+    trace.extend([{**event, "pid": pids[event["pid"]]} for event in events])
+    with open(path, "w") as f:
+        json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
@@ -0,0 +1,12 @@
+"""Modules for the benchmarks in `tests.test_benchmark`.
+
+They do the same sort of work as the real services, but only touch files under `BENCH_ROOT`
+so several of them can be run side by side on one machine.
+"""
+
+import os
+from pathlib import Path
+
+
+def bench_root() -> Path:
+    return Path(os.environ["BENCH_ROOT"])
@@ -0,0 +1,22 @@
+from paracrine.helpers.config import host
+from paracrine.helpers.debian import apt_install
+from paracrine.helpers.fs import (
+    make_directory,
+    run_command,
+    set_file_contents_from_template,
+)
+
+from . import bench_root
+
+cross_host_data = False
+
+
+def run():
+    apt_install(["bash"])
+    make_directory(bench_root().joinpath("etc"))
+    set_file_contents_from_template(
+        bench_root().joinpath("etc", "ntp.conf"),
+        "bench-ntp.conf.j2",
+        server=host()["name"],
+    )
+    run_command("cat /proc/uptime", dry_run_safe=True)
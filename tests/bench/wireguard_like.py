@@ -0,0 +1,31 @@
+import hashlib
+from typing import Dict, List
+
+from paracrine.helpers.config import host, other_config_file, servers
+from paracrine.helpers.fs import (
+    make_directory,
+    set_file_contents,
+    set_file_contents_from_template,
+)
+
+from . import bench_root
+
+
+def run():
+    make_directory(bench_root().joinpath("etc", "wireguard"))
+    set_file_contents_from_template(
+        bench_root().joinpath("etc", "wireguard", "wg0.conf"),
+        "bench-wg0.conf.j2",
+        peers=[server["name"] for server in servers() if server != host()],
+    )
+    return {
+        "name": host()["name"],
+        "public_key": hashlib.sha256(host()["name"].encode("utf-8")).hexdigest(),
+    }
+
+
+def parse_return(infos: List[Dict[str, str]]) -> None:
+    for info in infos:
+        set_file_contents(
+            other_config_file(f"wireguard-{info['name']}"), info["public_key"]
+        )
@@ -0,0 +1,73 @@
+import os
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+import pytest
+
+from paracrine.agent import attach, socket_path
+
+
+def test_attach_without_agent():
+    with tempfile.TemporaryDirectory() as raw_temp_directory:
+        assert not attach(os.path.join(raw_temp_directory, "agent.sock"), [])
+
+
+def test_socket_path_private(monkeypatch: pytest.MonkeyPatch):
+    with tempfile.TemporaryDirectory() as raw_temp_directory:
+        monkeypatch.delenv("XDG_RUNTIME_DIR", raising=False)
+        monkeypatch.setattr(tempfile, "tempdir", raw_temp_directory)
+        path = socket_path("inventory.yaml")
+        directory = os.path.dirname(path)
+        assert directory == os.path.join(raw_temp_directory, f"paracrine-{os.getuid()}")
+        assert stat.S_IMODE(os.stat(directory).st_mode) == 0o700
+        assert socket_path("inventory.yaml") == path
+
+        os.chmod(directory, 0o777)
+        with pytest.raises(Exception, match="only we can use"):
+            socket_path("inventory.yaml")
+
+
+def test_attach_checks_socket():
+    with tempfile.TemporaryDirectory() as raw_temp_directory:
+        path = os.path.join(raw_temp_directory, "agent.sock")
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+            server.bind(path)
+            os.chmod(path, 0o666)
+            with pytest.raises(Exception, match="only we can use"):
+                attach(path, [])
+
+
+def test_attach_to_agent(capsys: pytest.CaptureFixture[str]):
+    with tempfile.TemporaryDirectory() as raw_temp_directory:
+        path = os.path.join(raw_temp_directory, "agent.sock")
+        agent = subprocess.Popen(
+            [
+                sys.executable,
+                "-c",
+                "import sys\n"
+                "from paracrine.agent import serve\n"
+                "def handler(args):\n"
+                "    print('ran', args)\n"
+                "    if args == ['fail']:\n"
+                "        raise Exception('failure')\n"
+                f"serve({path!r}, handler)\n",
+            ]
+        )
+        try:
+            for _ in range(100):
+                if os.path.exists(path):
+                    break
+                time.sleep(0.1)
+
+            assert attach(path, ["-i", "foo"])
+            assert capsys.readouterr().out == "ran ['-i', 'foo']\n"
+
+            with pytest.raises(Exception, match="Exception: failure"):
+                attach(path, ["fail"])
+        finally:
+            agent.kill()
+            agent.wait()
@@ -0,0 +1,98 @@
+import hashlib
+import http.server
+import sys
+import threading
+from pathlib import Path
+from typing import Any, List
+
+import pytest
+from mitogen.parent import Context, Router
+from mitogen.utils import run_with_router
+
+from paracrine import DRY_RUN_ENV, artifacts
+from paracrine.helpers.fs import download
+
+CONTENT = b"artifact" * 100_000
+SHA = hashlib.sha256(CONTENT).hexdigest()
+
+
+def remote_download(controller: Context, url: str, fname: str, sha: str) -> bool:
+    import os
+
+    os.environ[DRY_RUN_ENV] = "False"
+    artifacts.set_controller(controller)
+    return download(url, fname, sha)
+
+
+def test_artifact_cache(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(artifacts, "ARTIFACTS_ROOT", tmp_path.joinpath("artifacts"))
+    requests: List[str] = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            requests.append(self.path)
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(CONTENT)))
+            self.end_headers()
+            self.wfile.write(CONTENT)
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/release.tar.gz"
+
+    def run(router: Router) -> None:
+        artifacts.serve(router, True)
+        controller = artifacts.controller(router)
+        assert controller is not None
+        for index in range(2):
+            context = router.local(
+                python_path=[
+                    "env",
+                    f"PARACRINE_CACHE_ROOT={tmp_path.joinpath(f'cache-{index}')}",
+                    sys.executable,
+                ]
+            )
+            fname = tmp_path.joinpath(f"release-{index}.tar.gz").as_posix()
+            assert context.call(remote_download, controller, url, fname, SHA)
+            assert Path(fname).read_bytes() == CONTENT
+
+        bad = router.local(python_path=sys.executable)
+        with pytest.raises(Exception, match="Expected"):
+            bad.call(
+                remote_download,
+                controller,
+                url.replace("release", "other"),
+                tmp_path.joinpath("other.tar.gz").as_posix(),
+                "0" * 64,
+            )
+
+    try:
+        run_with_router(run)
+    finally:
+        server.shutdown()
+        artifacts.set_controller(None)
+
+    # Fetched once for both servers. The bad hash never made it into the cache, and the server
+    # then tried downloading it itself
+    assert requests == ["/release.tar.gz", "/other.tar.gz", "/other.tar.gz"]
+    assert artifacts.artifact_path(url, SHA).read_bytes() == CONTENT
+    assert (
+        not artifacts.artifact_path(url, "0" * 64)
+        .parent.joinpath("other.tar.gz")
+        .exists()
+    )
+
+
+def test_artifact_path_checked():
+    url = "https://example.com/release.tar.gz"
+    assert artifacts.artifact_path(url, SHA) == artifacts.ARTIFACTS_ROOT.joinpath(
+        SHA, "release.tar.gz"
+    )
+    for bad_sha in ["../../etc", SHA.upper(), SHA[:-1]]:
+        with pytest.raises(Exception, match="isn't a sha256 hash"):
+            artifacts.artifact_path(url, bad_sha)
+    with pytest.raises(Exception, match="Can't cache"):
+        artifacts.artifact_path("https://example.com/..", SHA)
@@ -0,0 +1,147 @@
+"""Benchmarks of zero-change deploys.
+
+Each "server" is a local Mitogen context (`transport: local` in the inventory) with its own
+cache and files under a temporary root, so this covers the whole controller side and the remote
+runs, just without SSH.
+
+These only cover dry runs, as applying `paracrine.runners.core` would change the machine running
+the tests. Applied runs also write files and restart services, which isn't measured here.
+
+Timings are printed (see `pytest -s`), but only the counts are checked, as they're stable.
+"""
+
+import json
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, TypedDict
+from unittest.mock import patch
+
+import mitogen.core
+import pytest
+
+from paracrine import runner
+
+from .bench import ntp_like, wireguard_like
+
+SERVER_COUNT = 3
+
+
+class BenchResult(TypedDict):
+    seconds: float
+    bytes_sent: int
+    """Everything sent to the servers, including Python modules"""
+    call_bytes: int
+    """Just the function calls, and so the payloads from `paracrine.runner.run_on_servers`"""
+    subprocesses: int
+    payload_builds: int
+    """Calls to `paracrine.helpers.config.create_data`"""
+    server_runs: int
+    """Calls to `paracrine.runner.run_on_servers`"""
+
+
+def bench_server(temp_directory: Path, name: str) -> Dict[str, object]:
+    root = temp_directory.joinpath("servers", name)
+    return {
+        "name": name,
+        "transport": "local",
+        "python_path": [
+            "env",
+            f"BENCH_ROOT={root}",
+            f"PARACRINE_CACHE_ROOT={root.joinpath('cache')}",
+            sys.executable,
+        ],
+    }
+
+
+def run_deploy(temp_directory: Path, modules: runner.ModulesArg) -> BenchResult:
+    original_route = getattr(mitogen.core.Router, "_async_route")
+    bytes_sent = 0
+    call_bytes = 0
+
+    def counting_route(
+        self: mitogen.core.Router,
+        msg: mitogen.core.Message,
+        in_stream: Optional[object] = None,
+    ) -> None:
+        nonlocal bytes_sent, call_bytes
+        if in_stream is None:
+            bytes_sent += len(msg.data)
+            if msg.handle == mitogen.core.CALL_FUNCTION:
+                call_bytes += len(msg.data)
+        original_route(self, msg, in_stream)
+
+    trace_path = temp_directory.joinpath("trace.json")
+    with (
+        patch.object(mitogen.core.Router, "_async_route", counting_route),
+        patch.object(runner, "create_data", wraps=runner.create_data) as create_data,
+        patch.object(
+            runner, "run_on_servers", wraps=runner.run_on_servers
+        ) as run_on_servers,
+    ):
+        started = time.perf_counter()
+        runner.run(
+            [
+                "-i",
+                temp_directory.joinpath("inventory.yaml").as_posix(),
+                "--trace",
+                trace_path.as_posix(),
+            ],
+            modules,
+        )
+        seconds = time.perf_counter() - started
+
+    events: List[Dict[str, Any]] = json.loads(trace_path.read_text())["traceEvents"]
+    return {
+        "seconds": seconds,
+        "bytes_sent": bytes_sent,
+        "call_bytes": call_bytes,
+        "subprocesses": len([e for e in events if e.get("cat") == "subprocess"]),
+        "payload_builds": create_data.call_count,
+        "server_runs": run_on_servers.call_count,
+    }
+
+
+def test_zero_change_deploy(monkeypatch: pytest.MonkeyPatch) -> None:
+    with tempfile.TemporaryDirectory() as raw_temp_directory:
+        temp_directory = Path(raw_temp_directory)
+        monkeypatch.chdir(temp_directory)
+        shutil.copytree(
+            Path(__file__).parent.joinpath("bench", "templates"), "templates"
+        )
+        Path("configs").mkdir()
+        Path("config.yaml").write_text("environments: {}\n")
+        Path("inventory.yaml").write_text(
+            json.dumps(
+                {
+                    "environment": "bench",
+                    "data_path": ".",
+                    "servers": [
+                        bench_server(temp_directory, f"server-{i}")
+                        for i in range(SERVER_COUNT)
+                    ],
+                }
+            )
+        )
+
+        modules = [ntp_like, wireguard_like]
+        first = run_deploy(temp_directory, modules)
+        repeat = run_deploy(temp_directory, modules)
+
+    for name, result in [("first", first), ("repeat", repeat)]:
+        print(
+            f"{name}: {result['seconds']:.2f}s, {result['bytes_sent']} bytes sent "
+            f"({result['call_bytes']} in calls), {result['subprocesses']} subprocesses"
+        )
+
+    # Templates and data are read once for all the servers and stages of each call
+    assert first["payload_builds"] == first["server_runs"]
+    # Core's facts are cached on the servers after the first run
+    assert repeat["subprocesses"] < first["subprocesses"]
+    # The file contents are also cached on the servers, so the payloads are smaller
+    assert repeat["call_bytes"] < first["call_bytes"]
+    assert repeat["bytes_sent"] - repeat["call_bytes"] == (
+        first["bytes_sent"] - first["call_bytes"]
+    )
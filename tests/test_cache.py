@@ -0,0 +1,107 @@
+import os
+import stat
+import sys
+import tempfile
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, cast
+
+import pytest
+from mitogen.parent import Router
+from mitogen.utils import run_with_router
+
+from paracrine.helpers import cache
+from paracrine.helpers.cache import (
+    digest,
+    hash_payload,
+    missing_blobs,
+    payload_digests,
+    prune_blobs,
+    resolve_payload,
+    store_blob,
+)
+from paracrine.helpers.config import CONFIG_NAME, set_config
+from paracrine.runner import clear_ssh_cache, main
+
+from .conftest import set_config_data
+
+
+def test_payload_round_trip(monkeypatch: pytest.MonkeyPatch):
+    with tempfile.TemporaryDirectory() as raw_temp_directory:
+        monkeypatch.setattr(cache, "CACHE_ROOT", Path(raw_temp_directory))
+        monkeypatch.setattr(cache, "_blobs", {})
+        data = {
+            "templates": {"foo.j2": "{{ foo }}"},
+            "configs": {"config.yaml": "environments: {}"},
+            "data": {"bar": b"\x00\x01"},
+            "host": {"name": "foo"},
+        }
+        store_blob(digest("{{ foo }}"), b"{{ foo }}")
+        monkeypatch.setattr(cache, "_blobs", {})
+
+        digests = payload_digests(data)
+        missing = missing_blobs(digests)
+        assert sorted(missing) == sorted(digests.difference([digest("{{ foo }}")]))
+
+        hashed = hash_payload(data, digests.difference(missing))
+        assert hashed["templates"] == {"foo.j2": digest("{{ foo }}")}
+        assert sorted(hashed["blobs"].values()) == [b"\x00\x01", b"environments: {}"]
+        assert resolve_payload(hashed) == data
+        assert missing_blobs(digests) == []
+
+
+def test_prune_blobs(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(cache, "CACHE_ROOT", tmp_path)
+    monkeypatch.setattr(cache, "_blobs", {})
+    store_blob(digest("old secret"), b"old secret")
+    store_blob(digest("current"), b"current")
+    # As blobs can have secrets in
+    assert stat.S_IMODE(os.stat(cache.blob_path(digest("current"))).st_mode) == 0o600
+
+    assert prune_blobs([digest("current")]) == 1
+    assert missing_blobs([digest("old secret"), digest("current")]) == [
+        digest("old secret")
+    ]
+
+
+def remote_templates(data: Dict[str, Any]) -> Dict[str, str]:
+    return data["templates"]
+
+
+def test_main_sends_contents(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.chdir(tmp_path)
+    tmp_path.joinpath(CONFIG_NAME).write_text("environments: {}\n")
+    tmp_path.joinpath("configs").mkdir()
+    tmp_path.joinpath("templates").mkdir()
+    tmp_path.joinpath("templates", "foo.j2").write_text("{{ foo }}")
+    with open("inventory.yaml", "wb") as inventory:
+        set_config_data(
+            cast(BinaryIO, inventory),
+            {
+                "environment": "test",
+                "data_path": ".",
+                "servers": [
+                    {
+                        "name": "local",
+                        "transport": "local",
+                        "python_path": [
+                            "env",
+                            f"PARACRINE_CACHE_ROOT={tmp_path.joinpath('cache')}",
+                            sys.executable,
+                        ],
+                    }
+                ],
+            },
+        )
+    set_config("inventory.yaml")
+
+    infos: list[Dict[str, str]] = []
+
+    def run(router: Router) -> None:
+        infos.extend(main(router, None, remote_templates)["infos"])
+
+    try:
+        run_with_router(run)
+    finally:
+        clear_ssh_cache()
+    # Only `do` understands blobs, so other functions get the file contents themselves
+    assert [info["foo.j2"] for info in infos] == ["{{ foo }}"]
@@ -0,0 +1,22 @@
+import os
+import tempfile
+from pathlib import Path
+
+from paracrine.helpers.config import read_cached_bytes, read_cached_text
+
+
+def test_read_cached_only_rereads_changed_files():
+    with tempfile.TemporaryDirectory() as raw_temp_directory:
+        path = Path(raw_temp_directory).joinpath("foo")
+        path.write_text("first")
+        assert read_cached_text(path) == "first"
+
+        # Same size and mtime, so the cached copy is used
+        st = path.stat()
+        path.write_text("other")
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        assert read_cached_text(path) == "first"
+
+        path.write_text("changed contents")
+        assert read_cached_text(path) == "changed contents"
+        assert read_cached_bytes(path) == b"changed contents"
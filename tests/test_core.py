@@ -1,10 +1,24 @@
 import json
 import os
 import tempfile
+from typing import BinaryIO, Dict, List, cast
 
 import pytest
 
-from paracrine.runners.core import parse_return
+from paracrine.helpers.config import CONFIG_NAME, ServerDict, get_config, set_config
+from paracrine.runner import server_role_picker
+from paracrine.runners import core
+from paracrine.runners.core import (
+    Fact,
+    cached_fact,
+    clear_selectors,
+    flush_selectors,
+    parse_return,
+    rendezvous_index,
+    selectors,
+)
+
+from .conftest import set_config_data
 
 
 def test_no_infos_parse_return() -> None:
@@ -31,3 +45,125 @@ def test_parse_return(monkeypatch: pytest.MonkeyPatch) -> None:
         assert files == ["configs"]
         config_files = sorted(os.listdir(os.path.join(raw_temp_directory, "configs")))
         assert config_files == ["networks-foo", "other-foo"]
+
+
+def test_selectors_written_once(monkeypatch: pytest.MonkeyPatch) -> None:
+    with tempfile.TemporaryDirectory() as raw_temp_directory:
+        monkeypatch.chdir(raw_temp_directory)
+        monkeypatch.setenv("PARACRINE_DRY_RUN", "true")
+        os.mkdir("configs")
+        open(CONFIG_NAME, "w").close()
+        with open("inventory.yaml", "wb") as inventory:
+            set_config_data(
+                cast(BinaryIO, inventory),
+                {"data_path": ".", "servers": [{"name": "a"}, {"name": "b"}]},
+            )
+        set_config("inventory.yaml")
+        clear_selectors()
+
+        for server in get_config()["servers"]:
+            server_role_picker("first")(server)
+            server_role_picker("second")(server)
+        selector_path = os.path.join("configs", "other-selectors.json")
+        assert not os.path.exists(selector_path)
+
+        flush_selectors()
+        assert not os.path.exists(selector_path)
+
+        monkeypatch.setenv("PARACRINE_DRY_RUN", "false")
+        flush_selectors()
+        written = json.load(open(selector_path))
+        assert sorted(written.keys()) == ["first", "second"]
+
+        # Existing picks are kept, even if they're not what would be picked now
+        json.dump(
+            {"first": "b" if written["first"] == "a" else "a"}, open(selector_path, "w")
+        )
+        clear_selectors()
+        assert selectors()["first"] != written["first"]
+
+
+def make_servers(count: int) -> List[ServerDict]:
+    return [
+        {
+            "name": f"server-{i}",
+            "count": i,
+            "ssh_hostname": "",
+            "ssh_port": 22,
+            "ssh_key": "",
+            "ssh_user": "",
+        }
+        for i in range(count)
+    ]
+
+
+def test_rendezvous_moves_few_roles() -> None:
+    roles = [f"role-{i}" for i in range(1000)]
+    hosts = make_servers(10)
+    before = [hosts[rendezvous_index(role, hosts)]["name"] for role in roles]
+    # Roughly even spread
+    assert all(60 < before.count(host["name"]) < 140 for host in hosts)
+
+    more_hosts = make_servers(11)
+    after = [more_hosts[rendezvous_index(role, more_hosts)]["name"] for role in roles]
+    moved = [(b, a) for (b, a) in zip(before, after) if b != a]
+    assert all(a == "server-10" for (_, a) in moved)
+    assert len(moved) < 150
+
+
+def test_rendezvous_weights() -> None:
+    hosts = make_servers(2)
+    hosts[0]["selector_weight"] = 3.0
+    picks = [rendezvous_index(f"role-{i}", hosts) for i in range(1000)]
+    assert 650 < picks.count(0) < 850
+
+
+def test_parse_return_skips_unchanged_facts(monkeypatch: pytest.MonkeyPatch) -> None:
+    with tempfile.TemporaryDirectory() as raw_temp_directory:
+        monkeypatch.chdir(raw_temp_directory)
+        monkeypatch.setenv("PARACRINE_DRY_RUN", "false")
+        info: core.CoreReturn = {
+            "network_devices": json.dumps({}),
+            "server_name": "foo",
+            "users": [],
+            "groups": [],
+            "hostname": "foo",
+            "external_ip": json.dumps({"ip": "1.2.3.4"}),
+            "facts_hash": "abc",
+        }
+        parse_return([info])
+        assert sorted(os.listdir("configs")) == [
+            ".facts-foo",
+            "networks-foo",
+            "other-foo",
+        ]
+
+        # Same hash, so the files aren't looked at again
+        parse_return([{**info, "hostname": "bar"}])
+        assert json.load(open("configs/other-foo"))["hostname"] == "foo"
+
+        parse_return([{**info, "hostname": "bar", "facts_hash": "def"}])
+        assert json.load(open("configs/other-foo"))["hostname"] == "bar"
+
+
+def test_cached_fact(monkeypatch: pytest.MonkeyPatch) -> None:
+    with tempfile.TemporaryDirectory() as raw_temp_directory:
+        signal_path = os.path.join(raw_temp_directory, "passwd")
+        open(signal_path, "w").write("first")
+        monkeypatch.setitem(core.FACT_SIGNALS, "users", [signal_path])
+        facts: Dict[str, Fact] = {}
+        computed: List[str] = []
+
+        def compute() -> str:
+            computed.append("users")
+            return f"users-{len(computed)}"
+
+        assert cached_fact(facts, "users", compute) == "users-1"
+        assert cached_fact(facts, "users", compute) == "users-1"
+
+        os.utime(signal_path, ns=(0, 0))
+        assert cached_fact(facts, "users", compute) == "users-2"
+
+        facts["users"]["expires"] = 0
+        assert cached_fact(facts, "users", compute) == "users-3"
+        assert len(computed) == 3
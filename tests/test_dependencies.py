@@ -1,6 +1,12 @@
+from types import ModuleType
+from typing import List
+
+import pytest
+
 from paracrine.deps import Modules, maketransmit
 from paracrine.helpers.config import set_data
 from paracrine.runner import generate_dependencies
+from paracrine.runners import core
 from paracrine.services import cockroachdb, wireguard
 
 
@@ -36,3 +42,28 @@ def test_cockroach_versions():
         ("paracrine.services.cockroachdb.init", {"versions": {"foo": "23.1.1"}}),
         "paracrine.services.cockroachdb",
     ]
+
+
+def make_module(name: str, dependencies: Modules) -> ModuleType:
+    module = ModuleType(name)
+    setattr(module, "dependencies", lambda: dependencies)
+    return module
+
+
+def test_long_dependency_chain():
+    set_data({"templates": "", "inventory": {"servers": []}})
+    modules: List[ModuleType] = []
+    for index in range(500):
+        modules.append(make_module(f"chain_{index}", modules[-1:]))
+
+    assert generate_dependencies([modules[-1]]) == [core] + modules
+
+
+def test_dependency_cycle():
+    set_data({"templates": "", "inventory": {"servers": []}})
+    first = make_module("first", [])
+    second = make_module("second", [first])
+    setattr(first, "dependencies", lambda: [second])
+
+    with pytest.raises(Exception, match="Dependency cycle: first -> second -> first"):
+        generate_dependencies([first])
@@ -0,0 +1,332 @@
+import hashlib
+import http.server
+import logging
+import os
+import stat
+import tarfile
+import threading
+import zipfile
+from pathlib import Path
+from typing import Any, Iterator, List, Optional, Tuple
+
+import pytest
+
+from paracrine import DRY_RUN_ENV
+from paracrine.helpers import cache, debian, fs
+from paracrine.helpers.fs import (
+    download,
+    download_and_unpack,
+    download_many,
+    fetch_url,
+    set_file_contents,
+    sha_file,
+)
+
+
+@pytest.fixture(autouse=True)
+def not_dry_run(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv(DRY_RUN_ENV, "false")
+
+
+def test_set_file_contents(tmp_path: Path, caplog: pytest.LogCaptureFixture):
+    caplog.set_level(logging.INFO)
+    path = tmp_path.joinpath("foo.conf")
+    assert set_file_contents(path, "a\nb\n")
+    assert "was missing" in caplog.text
+    assert path.read_text() == "a\nb\n"
+
+    caplog.clear()
+    assert not set_file_contents(path, "a\nb\n")
+    assert not set_file_contents(path, b"a\nb\n")
+    assert caplog.text == ""
+
+    assert set_file_contents(path, "a\nc\n")
+    assert "-b\n+c\n" in caplog.text
+    assert path.read_text() == "a\nc\n"
+
+    assert set_file_contents(path, b"\xff\x00")
+    assert path.read_bytes() == b"\xff\x00"
+    assert [p.name for p in tmp_path.iterdir()] == ["foo.conf"]
+
+
+def test_set_file_contents_keeps_mode(tmp_path: Path):
+    path = tmp_path.joinpath("foo.conf")
+    path.write_text("old")
+    os.chmod(path, 0o640)
+    link = tmp_path.joinpath("link.conf")
+    link.symlink_to(path)
+
+    assert set_file_contents(link, "new")
+    assert link.is_symlink()
+    assert path.read_text() == "new"
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o640
+
+
+def test_set_file_contents_dry_run(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setenv(DRY_RUN_ENV, "true")
+    path = tmp_path.joinpath("foo.conf")
+    path.write_text("old")
+    assert set_file_contents(path, "new")
+    assert path.read_text() == "old"
+
+
+def test_big_diffs_skipped(
+    tmp_path: Path, caplog: pytest.LogCaptureFixture, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(fs, "MAX_DIFF_BYTES", 10)
+    caplog.set_level(logging.INFO)
+    path = tmp_path.joinpath("foo.conf")
+    path.write_text("a" * 20)
+    assert set_file_contents(path, "b" * 20)
+    assert "too big to diff" in caplog.text
+    assert "Diff is" not in caplog.text
+
+
+def test_sha_file_cached(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(cache, "CACHE_ROOT", tmp_path.joinpath("cache"))
+    path = tmp_path.joinpath("foo.tar.gz")
+    path.write_bytes(b"foo")
+    expected = hashlib.sha256(b"foo").hexdigest()
+    assert sha_file(path) == expected
+
+    # Unchanged files come straight from the cache
+    hashes = cache.load_json_cache(cache.FILE_HASHES_FILENAME)
+    hashes[str(path)]["sha256"] = "cached"
+    cache.save_json_cache(cache.FILE_HASHES_FILENAME, hashes)
+    assert sha_file(path) == "cached"
+
+    path.write_bytes(b"bar")
+    assert sha_file(path) == hashlib.sha256(b"bar").hexdigest()
+
+
+def test_sha_file_threads(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(cache, "CACHE_ROOT", tmp_path.joinpath("cache"))
+    paths = [tmp_path.joinpath(f"{i}.bin") for i in range(20)]
+    for path in paths:
+        path.write_bytes(path.name.encode("utf-8"))
+    threads = [threading.Thread(target=sha_file, args=(path,)) for path in paths]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(cache.load_json_cache(cache.FILE_HASHES_FILENAME).keys()) == sorted(
+        [str(path) for path in paths]
+    )
+
+
+CONTENT = os.urandom(300_000)
+
+
+@pytest.fixture
+def flaky_server() -> Iterator[Tuple[str, List[Optional[str]]]]:
+    """Serves CONTENT at any path, supporting ranges, but drops the first request part way"""
+    ranges: List[Optional[str]] = []
+    lock = threading.Lock()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            requested = self.headers.get("Range")
+            with lock:
+                first = ranges == []
+                ranges.append(requested)
+            start = 0 if requested is None else int(requested[6:].split("-")[0])
+            if start >= len(CONTENT):
+                self.send_error(416)
+                return
+            self.send_response(200 if requested is None else 206)
+            self.send_header("Content-Length", str(len(CONTENT) - start))
+            self.end_headers()
+            if first:
+                self.wfile.write(CONTENT[:100_000])
+                self.wfile.flush()
+                self.connection.shutdown(2)
+            else:
+                self.wfile.write(CONTENT[start:])
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield (f"http://127.0.0.1:{server.server_address[1]}", ranges)
+    finally:
+        server.shutdown()
+
+
+def test_fetch_url_resumes(
+    tmp_path: Path,
+    flaky_server: Tuple[str, List[Optional[str]]],
+    monkeypatch: pytest.MonkeyPatch,
+):
+    monkeypatch.setattr(fs, "DOWNLOAD_RETRY_DELAY", 0)
+    base_url, ranges = flaky_server
+    path = tmp_path.joinpath("foo.tar.gz")
+    fetch_url(f"{base_url}/foo.tar.gz", path, hashlib.sha256(CONTENT).hexdigest())
+    assert path.read_bytes() == CONTENT
+    assert ranges == [None, "bytes=100000-"]
+    assert not tmp_path.joinpath("foo.tar.gz.partial").exists()
+
+    with pytest.raises(Exception, match="Expected"):
+        fetch_url(f"{base_url}/bar.tar.gz", tmp_path.joinpath("bar.tar.gz"), "0" * 64)
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_fetch_url_already_complete(
+    tmp_path: Path, flaky_server: Tuple[str, List[Optional[str]]]
+):
+    base_url, ranges = flaky_server
+    path = tmp_path.joinpath("foo.tar.gz")
+    tmp_path.joinpath("foo.tar.gz.partial").write_bytes(CONTENT)
+    fetch_url(f"{base_url}/foo.tar.gz", path, hashlib.sha256(CONTENT).hexdigest())
+    assert path.read_bytes() == CONTENT
+    assert ranges == ["bytes=300000-"]
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_download_many(
+    tmp_path: Path,
+    flaky_server: Tuple[str, List[Optional[str]]],
+    monkeypatch: pytest.MonkeyPatch,
+):
+    monkeypatch.setattr(fs, "DOWNLOAD_RETRY_DELAY", 0)
+    monkeypatch.setattr(cache, "CACHE_ROOT", tmp_path.joinpath("cache"))
+    base_url, ranges = flaky_server
+    sha = hashlib.sha256(CONTENT).hexdigest()
+    downloads = [
+        (f"{base_url}/{i}", tmp_path.joinpath(f"{i}.bin").as_posix(), sha)
+        for i in range(3)
+    ]
+    assert download_many(downloads, mode="755") == [True, True, True]
+    for _, fname, _ in downloads:
+        assert Path(fname).read_bytes() == CONTENT
+        assert stat.S_IMODE(os.stat(fname).st_mode) == 0o755
+    assert len(ranges) == 4
+
+    assert download_many(downloads) == [False, False, False]
+    assert len(ranges) == 4
+
+
+def make_tar(path: Path, content: bytes) -> str:
+    source = path.parent.joinpath("source")
+    source.joinpath("bin").mkdir(parents=True, exist_ok=True)
+    source.joinpath("bin", "tool").write_bytes(content)
+    os.chmod(source.joinpath("bin", "tool"), 0o4755)
+    with tarfile.open(path, "w:gz") as tar:
+        tar.add(source.joinpath("bin"), "bin")
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def test_download_and_unpack_tar(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(cache, "CACHE_ROOT", tmp_path.joinpath("cache"))
+    archive = tmp_path.joinpath("tool.tar.gz")
+    target = tmp_path.joinpath("tool")
+    sha = make_tar(archive, b"v1")
+
+    def unpack(sha: str):
+        return download_and_unpack(
+            "http://unused/tool.tar.gz",
+            sha,
+            dir_name=target,
+            compressed_root=tmp_path.as_posix(),
+        )
+
+    assert unpack(sha) == {"changed": True, "dir_name": target}
+    assert target.joinpath("bin", "tool").read_bytes() == b"v1"
+    # setuid is kept, as with `tar -x` as root
+    assert stat.S_IMODE(os.stat(target.joinpath("bin", "tool")).st_mode) == 0o4755
+    assert tmp_path.joinpath("tool.tar.gz.unpacked").read_text() == sha
+    assert unpack(sha) == {"changed": False, "dir_name": target}
+
+    # A changed archive replaces what was there before
+    target.joinpath("stale").write_text("")
+    sha = make_tar(archive, b"v2")
+    assert unpack(sha)["changed"]
+    assert target.joinpath("bin", "tool").read_bytes() == b"v2"
+    assert not target.joinpath("stale").exists()
+    assert sorted(
+        [p.name for p in tmp_path.iterdir() if p.name.startswith("tool")]
+    ) == [
+        "tool",
+        "tool.tar.gz",
+        "tool.tar.gz.unpacked",
+    ]
+
+
+def test_download_and_unpack_existing(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(cache, "CACHE_ROOT", tmp_path.joinpath("cache"))
+    archive = tmp_path.joinpath("tool.tar.gz")
+    sha = make_tar(archive, b"v1")
+    target = tmp_path.joinpath("prefix")
+    target.mkdir()
+    target.joinpath("config").write_text("keep me")
+
+    # Directories this didn't make are unpacked into, not replaced
+    assert download_and_unpack(
+        "http://unused/tool.tar.gz",
+        sha,
+        dir_name=target,
+        compressed_root=tmp_path.as_posix(),
+    )["changed"]
+    assert target.joinpath("config").read_text() == "keep me"
+    assert target.joinpath("bin", "tool").read_bytes() == b"v1"
+    assert not target.joinpath(fs.UNPACKED_MARKER).exists()
+
+
+def test_download_and_unpack_zip(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(cache, "CACHE_ROOT", tmp_path.joinpath("cache"))
+    archive = tmp_path.joinpath("tool.zip")
+    with zipfile.ZipFile(archive, "w") as z:
+        tool = zipfile.ZipInfo("bin/tool")
+        tool.external_attr = (stat.S_IFREG | 0o755) << 16
+        z.writestr(tool, "#!/bin/sh\n")
+        link = zipfile.ZipInfo("bin/link")
+        link.external_attr = (stat.S_IFLNK | 0o777) << 16
+        z.writestr(link, "tool")
+        escape = zipfile.ZipInfo("bin/escape")
+        escape.external_attr = (stat.S_IFLNK | 0o777) << 16
+        z.writestr(escape, "../../../etc/passwd")
+    sha = hashlib.sha256(archive.read_bytes()).hexdigest()
+
+    with pytest.raises(Exception, match="links outside it"):
+        download_and_unpack(
+            "http://unused/tool.zip",
+            sha,
+            dir_name=tmp_path.joinpath("tool"),
+            compressed_root=tmp_path.as_posix(),
+        )
+    assert not tmp_path.joinpath("tool").exists()
+    assert not tmp_path.joinpath("tool.staging").exists()
+
+    with zipfile.ZipFile(archive, "w") as z:
+        z.writestr(tool, "#!/bin/sh\n")
+        z.writestr(link, "tool")
+    sha = hashlib.sha256(archive.read_bytes()).hexdigest()
+    unpacked = download_and_unpack(
+        "http://unused/tool.zip",
+        sha,
+        dir_name=tmp_path.joinpath("tool"),
+        compressed_root=tmp_path.as_posix(),
+    )
+    bin_dir = Path(unpacked["dir_name"]).joinpath("bin")
+    assert stat.S_IMODE(os.stat(bin_dir.joinpath("tool")).st_mode) == 0o755
+    assert os.readlink(bin_dir.joinpath("link")) == "tool"
+
+
+def test_download_installs_certificates(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    installed: List[List[str]] = []
+    monkeypatch.setattr(debian, "apt_install", installed.append)
+
+    def fake_fetch(url: str, fname: str, sha: str) -> None:
+        pass
+
+    monkeypatch.setattr(fs, "fetch_url", fake_fetch)
+    monkeypatch.setattr(cache, "CACHE_ROOT", tmp_path.joinpath("cache"))
+    fname = tmp_path.joinpath("tool").as_posix()
+
+    assert download("http://example.com/tool", fname, "0" * 64)
+    assert installed == []
+    assert download("https://example.com/tool", fname, "0" * 64)
+    assert installed == [["ca-certificates"]]
@@ -0,0 +1,33 @@
+from paracrine import memory
+from paracrine.helpers.cache import digest
+from paracrine.runner import CALL_OVERHEAD, call_memory, payload_sizes
+
+
+def test_phases():
+    memory.set_memory_report(True)
+    try:
+        with memory.phase("payload"):
+            kept = b"x" * 1024 * 1024
+            dropped = b"y" * 4 * 1024 * 1024
+            del dropped
+        stats = memory.phases()["payload"]
+        report = memory.report()
+    finally:
+        memory.set_memory_report(False)
+
+    assert stats["calls"] == 1
+    assert stats["peak"] > 4.9 * 1024 * 1024
+    assert 1024 * 1024 <= stats["retained"] < 2 * 1024 * 1024
+    assert report[0].startswith("Peak controller memory: ")
+    assert report[1].startswith(
+        "* payload: 5.0 MiB peak, 1.0 MiB retained over 1 calls"
+    )
+    assert len(kept) > 0
+
+
+def test_call_memory():
+    sizes = payload_sizes(
+        {"templates": {"a": "1234"}, "configs": {}, "data": {"b": b"12345678"}}
+    )
+    assert call_memory(sizes, set()) == CALL_OVERHEAD + 24
+    assert call_memory(sizes, set([digest("1234")])) == CALL_OVERHEAD + 16
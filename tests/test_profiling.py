@@ -0,0 +1,92 @@
+import os
+import tempfile
+from pathlib import Path
+from typing import Any, Dict
+
+import pytest
+
+from paracrine import profiling, runner
+from paracrine.deps import maketransmit
+from paracrine.helpers import cache
+from paracrine.runner import do
+
+from .bench import ntp_like, wireguard_like
+
+
+def inner() -> int:
+    return sum(range(100000))
+
+
+def outer() -> int:
+    return inner() + inner()
+
+
+def test_profiles_merged_per_module():
+    profiling.set_profiling(True)
+    try:
+        for _ in range(2):
+            with profiling.profiled("foo"):
+                outer()
+        # As from two servers
+        stats = profiling.take_stats()
+        assert len(stats["foo"]) == 2
+        profiling.add_remote_stats(stats)
+        profiling.add_remote_stats(stats)
+
+        with tempfile.TemporaryDirectory() as raw_temp_directory:
+            paths = profiling.write_profiles(raw_temp_directory)
+            assert [os.path.basename(path) for path in paths] == [
+                "foo.pstats",
+                "foo.folded",
+            ]
+            folded = open(paths[1]).read().splitlines()
+    finally:
+        profiling.set_profiling(False)
+
+    stacks = [line.rsplit(" ", 1)[0] for line in folded]
+    assert any(
+        [
+            stack.endswith("outer (test_profiling.py:20);inner (test_profiling.py:16)")
+            for stack in stacks
+        ]
+    )
+
+
+def test_parallel_modules_profiled_together(monkeypatch: pytest.MonkeyPatch):
+    with tempfile.TemporaryDirectory() as raw_temp_directory:
+        monkeypatch.setattr(cache, "CACHE_ROOT", Path(raw_temp_directory, "cache"))
+        monkeypatch.setenv("BENCH_ROOT", raw_temp_directory)
+        data: Dict[str, Any] = {
+            "templates": {
+                "bench-ntp.conf.j2": "server {{ server }}",
+                "bench-wg0.conf.j2": "{{ peers }}",
+            },
+            "configs": {},
+            "data": {},
+            "host": {"name": "foo"},
+            "inventory": {"servers": [{"name": "foo"}]},
+        }
+        results = do(
+            data,
+            maketransmit([ntp_like, wireguard_like]),
+            "run",
+            True,
+            waves=[[0, 1]],
+            max_workers=2,
+            profile=True,
+        )
+
+    stats = results[profiling.PROFILE_KEY]
+    assert list(stats.keys()) == ["tests.bench.ntp_like+tests.bench.wireguard_like"]
+    assert results["tests.bench.wireguard_like"] != []
+
+
+def test_profiling_off_after_failed_run(monkeypatch: pytest.MonkeyPatch):
+    def failing(modules: Any, name: str) -> Dict[str, Any]:
+        raise Exception("Broken")
+
+    monkeypatch.setattr(runner, "runfunc", failing)
+    data: Dict[str, Any] = {"templates": {}, "configs": {}, "data": {}}
+    with pytest.raises(Exception, match="Broken"):
+        runner.do(data, maketransmit([ntp_like]), "run", True, profile=True)
+    assert not profiling.enabled
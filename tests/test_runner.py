@@ -1,16 +1,34 @@
+import importlib
+import sys
 import tempfile
-from typing import BinaryIO, cast
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Dict, Optional, cast
 from unittest.mock import MagicMock, call, patch
 
+import pytest
 from callee import InstanceOf, List, String
 from mitogen.parent import Router
 
-from paracrine.deps import Module
-from paracrine.helpers import cron
-from paracrine.runner import run, server_name_filter, server_role_picker
-from paracrine.runners import aws, certs, core
+from paracrine import runner
+from paracrine.deps import Module, maketransmit
+from paracrine.helpers import cache, cron
+from paracrine.helpers.config import CONFIG_NAME
+from paracrine.runner import (
+    DependencyGraph,
+    barrier_segments,
+    batch_count,
+    do,
+    module_fingerprints,
+    module_waves,
+    pipeline_batches,
+    run,
+    server_name_filter,
+    server_role_picker,
+)
+from paracrine.runners import aws, certs, core, diskfree
 from paracrine.services import ntp, postgresql
 
+from .bench import ntp_like
 from .conftest import set_config_data
 
 
@@ -123,3 +141,191 @@ def test_runner_server_role_picker():
             )
 
         assert get_run_sets(mock_internal_runner) == [(["foo"], [core, ntp])]
+
+
+def test_pipeline_batches():
+    assert pipeline_batches([cron, aws, ntp, core, certs, ntp], "parse_return") == [
+        [cron, aws, ntp, core],
+        [certs],
+        [ntp],
+    ]
+
+
+def test_batch_count():
+    assert batch_count("2", 10) == 2
+    assert batch_count("25%", 10) == 3
+    assert batch_count("0%", 10) == 1
+
+
+def test_module_waves():
+    graph: DependencyGraph = {
+        "paracrine.runners.aws": [],
+        "paracrine.helpers.cron": [],
+        "paracrine.runners.certs": ["paracrine.runners.aws", "paracrine.helpers.cron"],
+        "paracrine.services.ntp": [],
+    }
+    assert module_waves([aws, cron, ntp, certs, (ntp, {"foo": "bar"})], graph) == [
+        [0, 1, 2],
+        [3, 4],
+    ]
+
+
+def test_barrier_segments():
+    assert barrier_segments([[core], [ntp, diskfree], [certs], [diskfree]]) == [
+        [[core], [ntp, diskfree]],
+        [[certs], [diskfree]],
+    ]
+
+
+def test_unchanged_modules_skipped(monkeypatch: pytest.MonkeyPatch):
+    with tempfile.TemporaryDirectory() as raw_temp_directory:
+        temp_directory = Path(raw_temp_directory)
+        monkeypatch.setattr(cache, "CACHE_ROOT", temp_directory.joinpath("cache"))
+        monkeypatch.setenv("BENCH_ROOT", raw_temp_directory)
+        monkeypatch.setenv("PARACRINE_DRY_RUN", "false")
+        data: Dict[str, Any] = {
+            "templates": {"bench-ntp.conf.j2": "server {{ server }}"},
+            "configs": {},
+            "data": {},
+            "host": {"name": "foo"},
+            "inventory": {"servers": [{"name": "foo"}]},
+        }
+        assert module_fingerprints([ntp, ntp_like], "parse_return") != {}
+        assert module_fingerprints([core, diskfree], "parse_return") == {}
+
+        def apply(**kwargs: Any) -> bool:
+            conf = temp_directory.joinpath("etc", "ntp.conf")
+            if conf.exists():
+                conf.unlink()
+            do(
+                data,
+                maketransmit([ntp_like]),
+                "run",
+                False,
+                fingerprints=module_fingerprints([ntp_like], "parse_return"),
+                **kwargs,
+            )
+            return conf.exists()
+
+        assert apply()
+        assert not apply()
+        assert apply(force=True)
+
+        data["templates"]["bench-ntp.conf.j2"] = "pool {{ server }}"
+        assert apply()
+        assert not apply()
+
+        data["host"] = {"name": "bar"}
+        assert apply()
+
+
+def run_sets_for(
+    args: list[str],
+    modules: list[Module],
+    side_effect: Optional[Callable[..., None]] = None,
+    inventory_directory: Optional[Path] = None,
+):
+    with patch(
+        "paracrine.runner.internal_runner", side_effect=side_effect
+    ) as mock_internal_runner:
+        with tempfile.NamedTemporaryFile(dir=inventory_directory) as config_file:
+            set_config_data(
+                cast(BinaryIO, config_file),
+                {
+                    "data_path": ".",
+                    "servers": [{"name": "web-1"}, {"name": "web-2"}, {"name": "db"}],
+                },
+            )
+            run(["-i", config_file.name] + args, modules)
+
+        return get_run_sets(mock_internal_runner)
+
+
+def test_runner_only():
+    assert run_sets_for(["--only", "certs"], [certs, ntp]) == [
+        (["db", "web-1", "web-2"], [core, cron, aws, certs])
+    ]
+
+
+def test_runner_skip():
+    assert run_sets_for(["--skip", "cron,paracrine.services.*"], [certs, ntp]) == [
+        (["db", "web-1", "web-2"], [core, aws, certs])
+    ]
+
+
+def test_runner_only_no_match():
+    with pytest.raises(Exception, match="--only foo doesn't match any modules"):
+        run_sets_for(["--only", "foo"], [ntp])
+
+
+def test_runner_limit():
+    assert run_sets_for(["--limit", "web-*"], [ntp]) == [
+        (["web-1", "web-2"], [core, ntp])
+    ]
+    assert run_sets_for(["--limit", "db", "--limit", "web-2"], [ntp]) == [
+        (["db", "web-2"], [core, ntp])
+    ]
+
+
+def test_runner_limit_role(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.chdir(tmp_path)
+    tmp_path.joinpath(CONFIG_NAME).touch()
+    selector_path = tmp_path.joinpath("configs", "other-selectors.json")
+    selector_path.parent.mkdir()
+    selector_path.write_text('{"foo": "web-2"}')
+
+    assert run_sets_for(["--limit", "role:foo"], [ntp], None, tmp_path) == [
+        (["web-2"], [core, ntp])
+    ]
+
+    # Typos don't get a server picked for them
+    with pytest.raises(Exception, match=r"unknown roles \['fo'\]"):
+        run_sets_for(["--limit", "role:fo"], [ntp], None, tmp_path)
+    assert selector_path.read_text() == '{"foo": "web-2"}'
+
+
+def test_rolling_carries_on_past_allowed_failures(capsys: pytest.CaptureFixture[str]):
+    def fail_web_1(_: Router, servers: list[str], *args: Any) -> None:
+        if "web-1" in servers:
+            runner.record_failure("web-1", Exception("web-1 failed"))
+
+    # Each batch gets all its modules before the next one starts
+    rolling_args = ["--batch-size", "1", "--max-failures", "1"]
+    assert run_sets_for(rolling_args, [ntp], fail_web_1) == [
+        (["web-1"], [core, ntp]),
+        (["web-2"], [core, ntp]),
+        (["db"], [core, ntp]),
+    ]
+    assert "Failed on ['web-1']" in capsys.readouterr().out
+
+    with pytest.raises(Exception, match="web-1 failed"):
+        run_sets_for(["--batch-size", "1"], [ntp], fail_web_1)
+
+
+def test_fingerprints_cover_imports(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, "path", [tmp_path.as_posix()] + sys.path)
+    package = tmp_path.joinpath("fingerprinted")
+    package.mkdir()
+    package.joinpath("__init__.py").write_text("")
+    package.joinpath("common.py").write_text("VERSION = 1\n")
+    package.joinpath("service.py").write_text(
+        "from .common import VERSION\n\ndef run():\n    return VERSION\n"
+    )
+    service = importlib.import_module("fingerprinted.service")
+    try:
+        first = module_fingerprints([service], "parse_return")
+        assert set(cache.local_sources(service).keys()) == {
+            "fingerprinted",
+            "fingerprinted.common",
+            "fingerprinted.service",
+        }
+        assert module_fingerprints([service], "parse_return") == first
+
+        package.joinpath("common.py").write_text("VERSION = 20\n")
+        assert module_fingerprints([service], "parse_return") != first
+    finally:
+        for name in ["fingerprinted.service", "fingerprinted.common", "fingerprinted"]:
+            sys.modules.pop(name, None)
@@ -70,3 +70,47 @@ def test_host_key_error(capsys: pytest.CaptureFixture[str]):
                 f"Try running the following manually: ssh test_user@foo -p 22 -i {key_path.as_posix()}"
                 in res.out
             ), res.out
+
+
+def test_multiple_connection_errors():
+    with patch("mitogen.parent.Router.ssh", side_effect=HostKeyError):
+        with tempfile.TemporaryDirectory() as raw_temp_directory:
+            temp_directory = Path(raw_temp_directory)
+            config_file_path = temp_directory.joinpath("config.yaml")
+            with config_file_path.open("wb") as config_file:
+                set_config_data(
+                    cast(BinaryIO, config_file),
+                    {
+                        "data_path": ".",
+                        "servers": [
+                            {
+                                "name": name,
+                                "ssh_hostname": name,
+                                "ssh_key": "key_path",
+                                "ssh_user": "test_user",
+                            }
+                            for name in ["foo", "bar"]
+                        ],
+                    },
+                )
+            configs_folder = temp_directory.joinpath("configs")
+            configs_folder.mkdir()
+            configs_folder.joinpath("key_path").open("w").write("test")
+            with pytest.raises(Exception) as exc_info:
+                run(["-i", config_file_path.as_posix()], [ntp])
+
+            errors = exc_info.value.args[0]
+            assert [type(error) for error in errors] == [HostKeyError, HostKeyError]
+
+
+def test_unknown_transport():
+    with tempfile.NamedTemporaryFile() as config_file:
+        set_config_data(
+            cast(BinaryIO, config_file),
+            {
+                "data_path": ".",
+                "servers": [{"name": "foo", "transport": "telnet"}],
+            },
+        )
+        with pytest.raises(Exception, match="Unknown transport 'telnet' for foo"):
+            run(["-i", config_file.name], [ntp])
@@ -0,0 +1,68 @@
+import json
+import tempfile
+from pathlib import Path
+from typing import Any, Dict
+
+import pytest
+
+from paracrine import runner, tracing
+from paracrine.deps import maketransmit
+
+from .bench import ntp_like
+
+
+def test_write_trace():
+    tracing.set_tracing(True)
+    try:
+        with tracing.span("local", "local"):
+            pass
+        with tracing.track("foo"):
+            with tracing.span("run", "remote"):
+                pass
+        tracing.add_remote_events(
+            "bar",
+            [{"name": "run", "cat": "run", "ph": "X", "ts": 5.0, "dur": 1.0}],
+            100.0,
+        )
+        with tempfile.TemporaryDirectory() as raw_temp_directory:
+            trace_path = Path(raw_temp_directory).joinpath("trace.json")
+            tracing.write_trace(trace_path.as_posix())
+            events = json.loads(trace_path.read_text())["traceEvents"]
+    finally:
+        tracing.set_tracing(False)
+
+    names = dict(
+        [
+            (event["pid"], event["args"]["name"])
+            for event in events
+            if event["ph"] == "M"
+        ]
+    )
+    assert sorted(names.values()) == ["bar", "controller", "foo"]
+    spans = [
+        (names[event["pid"]], event["name"]) for event in events if event["ph"] == "X"
+    ]
+    assert spans == [("controller", "local"), ("foo", "run"), ("bar", "run")]
+    assert [
+        event["ts"]
+        for event in events
+        if event["ph"] == "X" and names[event["pid"]] == "bar"
+    ] == [105.0]
+
+
+def test_disabled_tracing_records_nothing():
+    tracing.set_tracing(False)
+    with tracing.span("local", "local"):
+        pass
+    assert tracing.take_events() == []
+
+
+def test_tracing_off_after_failed_run(monkeypatch: pytest.MonkeyPatch):
+    def failing(modules: Any, name: str) -> Dict[str, Any]:
+        raise Exception("Broken")
+
+    monkeypatch.setattr(runner, "runfunc", failing)
+    data: Dict[str, Any] = {"templates": {}, "configs": {}, "data": {}}
+    with pytest.raises(Exception, match="Broken"):
+        runner.do(data, maketransmit([ntp_like]), "run", True, trace=True)
+    assert not tracing.enabled
@@ -1,4 +1,6 @@
-from typing import Any
+from typing import Any, Callable
+
+CALL_FUNCTION: int
 
 class Error(Exception):
     pass
@@ -6,8 +8,27 @@ class Error(Exception):
 class StreamError(Error):
     pass
 
-class Message:
-    def unpickle(self) -> Any: ...
+class CallError(Error):
+    pass
 
 class Receiver:
     def get(self) -> Message: ...
+
+class Message:
+    receiver: Receiver
+    handle: int
+    data: bytes
+    def unpickle(self) -> Any: ...
+
+def listen(obj: object, name: str, func: Callable[..., Any]) -> None: ...
+
+class Broker:
+    pass
+
+class Router:
+    broker: Broker
+    def myself(self) -> Context: ...
+
+class Context:
+    router: Router
+    def call_service(self, service_name: str, method_name: str, **kwargs: Any) -> Any: ...
@@ -1,17 +1,19 @@
-from typing import Any, Callable, Optional, TypeVar
+from typing import Any, Callable, List, Optional, Union
 
-from mitogen.core import Error
+import mitogen.core
 
-T = TypeVar("T")
+from mitogen.core import Error, Receiver
 
-class Context:
-    def call_async(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T: ...
+class Context(mitogen.core.Context):
+    def call_async(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Receiver: ...
+    def call(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any: ...
 
-class Router:
+class Router(mitogen.core.Router):
+    def local(self, python_path: Union[str, List[str], None] = None) -> Context: ...
     def sudo(
         self,
         via: Optional[Context] = None,
-        python_path: Optional[str] = None,
+        python_path: Union[str, List[str], None] = None,
         preserve_env: Optional[bool] = None,
     ) -> Context: ...
     def ssh(self) -> Context: ...
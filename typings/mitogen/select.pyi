@@ -0,0 +1,12 @@
+from typing import Iterable, Optional
+
+from mitogen.core import Message, Receiver
+
+class Select:
+    def __init__(
+        self, receivers: Iterable[Receiver] = (), oneshot: bool = True
+    ) -> None: ...
+    def __bool__(self) -> bool: ...
+    def add(self, recv: Receiver) -> None: ...
+    def get(self, timeout: Optional[float] = None, block: bool = True) -> Message: ...
+    def close(self) -> None: ...
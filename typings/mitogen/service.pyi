@@ -0,0 +1,34 @@
+from typing import Any, Callable, Dict, Iterable, Tuple, TypeVar
+
+import mitogen.core
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+class Policy: ...
+class AllowAny(Policy): ...
+class AllowParents(Policy): ...
+
+def expose(policy: Policy) -> Callable[[F], F]: ...
+def arg_spec(spec: Dict[str, type]) -> Callable[[F], F]: ...
+
+class Service:
+    router: mitogen.core.Router
+    def __init__(self, router: mitogen.core.Router) -> None: ...
+    @classmethod
+    def name(cls) -> str: ...
+
+class FileService(Service):
+    def register(self, path: str) -> None: ...
+    @classmethod
+    def get(
+        cls, context: mitogen.core.Context, path: str, out_fp: Any
+    ) -> Tuple[bool, Dict[str, Any]]: ...
+
+class Pool:
+    def __init__(
+        self,
+        router: mitogen.core.Router,
+        services: Iterable[Service] = (),
+        size: int = 1,
+    ) -> None: ...
+    def stop(self, join: bool = True) -> None: ...